@@ -0,0 +1,156 @@
+# coding: utf-8
+"""
+Resumable output files for long jobs.
+
+A job killed by the wall time limit of its queue slot should neither lose
+the chunks it already wrote nor leave a file behind that looks finished.
+With a chunk_journal the job writes into ofile.part and records every time
+chunk that safely reached the disk in a small JSON sidecar, ofile.journal,
+together with fingerprints of the input files and the settings the output
+depends on. A rerun of the same job finds the journal, checks that inputs
+and settings are unchanged and only computes the chunks still missing;
+anything else starts from scratch. Once all chunks are written,
+ofile.part is renamed to ofile, which is atomic, and the journal removed,
+so ofile either does not exist or is complete. Jobs written in one go
+(remap, interpolate) only use part_name() and the rename.
+
+A chunk may only be marked once its data is on disk, i.e. after the
+writable() mapping it went to was synced; a chunk marked too early would
+be skipped on resumption although the file never got it.
+
+Usage:
+
+    import checkpoint
+
+    journal = checkpoint.chunk_journal(ofile, [ifile], {"dtype": "float32"})
+    if not journal.resume():
+        # create journal.part and lay out all variables in it
+        journal.start()
+    out = pism_output_file.open(journal.part).writable("air_temp")
+    for t0, t1 in journal.pending("air_temp", pipeline.time_chunks(ntime, 12)):
+        out[t0:t1] = ...
+        # flush out to disk before the chunk is recorded
+        journal.mark("air_temp", (t0, t1))
+    journal.publish()
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+PART_SUFFIX = ".part"
+JOURNAL_SUFFIX = ".journal"
+
+# Bytes hashed at the start and at the end of every input file
+_SAMPLE_BYTES = 2**20
+
+
+##########
+# CLASSES
+##########
+
+class chunk_journal(object):
+    """
+    Keyword Arguments:
+    ofile    -- file the job produces, it is written to ofile.part until complete
+    inputs   -- files the output is computed from
+    settings -- (default None) dict of everything else the output depends on, must be JSON serializable
+    """
+    def __init__(self, ofile, inputs, settings=None):
+        self.ofile = ofile
+        self.part = part_name(ofile)
+        self.filename = ofile + JOURNAL_SUFFIX
+        # Compared with what json.load gives back, so tuples become lists here as well
+        self.inputs = json.loads(json.dumps(
+            dict((os.path.abspath(f), file_fingerprint(f)) for f in inputs)))
+        self.settings = json.loads(json.dumps(settings or {}))
+        self.done = {}
+
+    def resume(self):
+        """True if the journal of the same job was found; its chunks then count as done."""
+        state = None
+        if os.path.exists(self.filename) and os.path.exists(self.part):
+            try:
+                with open(self.filename) as f:
+                    state = json.load(f)
+            except ValueError:
+                logging.warning("Journal %s is unreadable, starting over" % self.filename)
+        if state is not None and (state.get("inputs") != self.inputs or
+                                  state.get("settings") != self.settings):
+            logging.warning("Inputs or settings changed since %s was written, starting over"
+                            % self.filename)
+            state = None
+        if state is None:
+            self.discard()
+            return False
+        self.done = dict((name, set(tuple(key) for key in keys))
+                         for name, keys in state["done"].items())
+        logging.info("Resuming %s, %d chunks already done"
+                     % (self.ofile, sum(len(keys) for keys in self.done.values())))
+        return True
+
+    def start(self):
+        """Starts a new journal, call it once ofile.part is laid out."""
+        self.done = {}
+        self._save()
+
+    def pending(self, name, keys):
+        """The keys of variable name that are not done yet, in their order."""
+        done = self.done.get(name, ())
+        return [key for key in keys if tuple(key) not in done]
+
+    def mark(self, name, key):
+        """Records chunk key of variable name as done; its data must be on disk already."""
+        self.done.setdefault(name, set()).add(tuple(key))
+        self._save()
+
+    def publish(self):
+        """Renames ofile.part to ofile and removes the journal."""
+        os.rename(self.part, self.ofile)
+        os.remove(self.filename)
+        logging.debug("Published %s" % self.ofile)
+
+    def discard(self):
+        """Removes ofile.part and the journal of an earlier run, if there are any."""
+        for filename in (self.part, self.filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _save(self):
+        state = {"ofile": self.ofile,
+                 "inputs": self.inputs,
+                 "settings": self.settings,
+                 "done": dict((name, sorted(list(key) for key in keys))
+                              for name, keys in self.done.items())}
+        # Write to a temporary file first, so an interrupted job never leaves
+        # a truncated journal behind
+        tmp_file = self.filename + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(state, f, indent=1)
+        os.rename(tmp_file, self.filename)
+
+
+############
+# FUNCTIONS
+############
+
+def file_fingerprint(filename):
+    """
+    Size, modification time and a hash of the first and last _SAMPLE_BYTES
+    of filename. Hashing every byte of multi gigabyte GCM output would take
+    longer than many of the chunks it protects.
+    """
+    stat = os.stat(filename)
+    key = hashlib.md5()
+    with open(filename, "rb") as f:
+        key.update(f.read(_SAMPLE_BYTES))
+        if stat.st_size > _SAMPLE_BYTES:
+            f.seek(max(_SAMPLE_BYTES, stat.st_size - _SAMPLE_BYTES))
+            key.update(f.read(_SAMPLE_BYTES))
+    return [stat.st_size, int(stat.st_mtime), key.hexdigest()]
+
+
+def part_name(ofile):
+    """The name ofile is written under until it is complete."""
+    return ofile + PART_SUFFIX
@@ -5,12 +5,15 @@ import numpy as np
 import time
 import argparse
 from scipy.io import netcdf
+from scipy import ndimage
 import matplotlib.pyplot as plt
 import logging
 import sys
 from matplotlib.colors import Normalize
 import warnings
+import shutil
 from matplotlib.colors import from_levels_and_colors
+import profiling
 
 
 class bcolors:
@@ -92,17 +95,101 @@ def parse_arguments():
                         action="store_const", dest="loglevel", const=logging.INFO)
     parser.add_argument("-p", "--plot", help="Plots the fields to check", 
                         action="store_true", dest="plot")
+    parser.add_argument("--profile", help="write a timing/counter trace (Chrome trace JSON) to this file",
+                        nargs="?", const="profile.json", default=None)
     return parser.parse_args()
 
 
-def downscale_field(field_lo, elev_hi, elev_lo, mask, half_a_box=50):
+def _window_min_max(a, size):
+    """
+    nanmin/nanmax over the windows a[..., i-hy:i+hy, j-hx:j+hx] for every
+    (i, j), size is (..., 2*hy, 2*hx). An even size puts the window at
+    offsets -h..h-1, the same cells the original loop sliced. Only cells at
+    least h away from the border are meaningful.
+    """
+    a = np.asarray(a)
+    if a.dtype.kind != "f":
+        a = a.astype(np.float64)
+    nan = np.isnan(a)
+    window_min = ndimage.minimum_filter(np.where(nan, np.inf, a), size=size, mode="nearest")
+    window_max = ndimage.maximum_filter(np.where(nan, -np.inf, a), size=size, mode="nearest")
+    # Windows with nothing but NaNs
+    window_min[np.isinf(window_min)] = np.nan
+    window_max[np.isinf(window_max)] = np.nan
+    return window_min, window_max
+
+
+def downscale_statics(elev_hi, elev_lo, mask, half_a_box=50):
+    """
+    Everything downscale_field needs that does not depend on the field:
+    the window statistics of the low resolution orography, the cells that
+    get a value and the window center each of them takes its lapse rate
+    from. Compute it once and pass it to downscale_field(statics=...) for
+    every variable that is downscaled with the same orography and mask.
+
+    Keyword Arguments:
+    elev_hi    -- the elevation at the high resolution
+    elev_lo    -- the elevation at the low resolution
+    mask       -- the mask where the ice sheet area is found in the domain. <=0 will be excluded, >0 will be utilized.
+    half_a_box -- (default 50)
+    """
+    elev_hi = np.asarray(elev_hi).squeeze()
+    elev_lo = np.asarray(elev_lo).squeeze()
+    mask = np.asarray(mask).squeeze()
+    if elev_hi.ndim != elev_lo.ndim:
+        logging.critical("The orography fields have different dimensions, you need to fix this!")
+        logging.critical("High resolution is: " + str(elev_hi.shape))
+        logging.critical("Lo resolution is: " + str(elev_lo.shape))
+        sys.exit("catastrophe! goodbye...")
+    half_a_box_y = int(round(0.8 * half_a_box))
+    half_a_box_x = int(round(half_a_box))
+    logging.warning("Half a box x and y are: (%s, %s)" % (half_a_box_x, half_a_box_y))
+    LY, LX = np.shape(mask)
+    logging.info("Shape will be %s,  %s" % (LY, LX))
+    size = (2 * half_a_box_y, 2 * half_a_box_x)
+    min_elev_lo, max_elev_lo = _window_min_max(elev_lo, size)
+    # Window centers run over i in [hy, LY-hy), j in [hx, LX-hx). The
+    # centers in the first/last row and column also fill the border strip
+    # next to them, i.e. every cell takes the lapse rate of the nearest
+    # center.
+    rows = np.clip(np.arange(LY), half_a_box_y, LY - half_a_box_y - 1)
+    cols = np.clip(np.arange(LX), half_a_box_x, LX - half_a_box_x - 1)
+    center_i, center_j = np.meshgrid(rows, cols, indexing="ij")
+    target = (mask > 0) & (mask[center_i, center_j] > 0)
+    if LY <= 2 * half_a_box_y or LX <= 2 * half_a_box_x:
+        # The box is larger than the domain, nothing is downscaled
+        target[:] = False
+    center_i = center_i[target]
+    center_j = center_j[target]
+    return {"half_a_box_x": half_a_box_x,
+            "half_a_box_y": half_a_box_y,
+            "shape": (LY, LX),
+            "target": target,
+            "center_i": center_i,
+            "center_j": center_j,
+            "elev_range": max_elev_lo[center_i, center_j] - min_elev_lo[center_i, center_j],
+            "delta_elev": (elev_hi - elev_lo)[target]}
+
+
+def downscale_field(field_lo, elev_hi, elev_lo, mask, half_a_box=50, statics=None,
+                    dtype=np.float32, out=None):
     """
     Keyword Arguments:
     field_lo   -- the field you want to downscale at the low resolution, resampled to high resolution
     elev_hi    -- the elevation at the high resolution
     elev_lo    -- the elevation at the low resolution
     mask       -- the mask where the ice sheet area is found in the domain. <=0 will be excluded, >0 will be utilized.
-    half_a_box -- (default 20)
+    half_a_box -- (default 50)
+    statics    -- (default None) result of downscale_statics(elev_hi, elev_lo, mask, half_a_box),
+                  if given elev_hi, elev_lo, mask and half_a_box are not used
+    dtype      -- (default np.float32) precision of the result, GCM fields are single precision anyway
+    out        -- (default None) preallocated (or memory mapped) array of the field's shape
+                  the result is written to, dtype is then taken from it
+
+    Within a box around every ice cell, the lapse rate is the range of the
+    field divided by the range of the low resolution orography. The field
+    is corrected with it for the difference between the high and low
+    resolution orography. Cells outside the mask are NaN.
 
     Paul J. Gierz, Wed Oct 19 10:11:01 2016
     """
@@ -112,154 +199,45 @@ def downscale_field(field_lo, elev_hi, elev_lo, mask, half_a_box=50):
     if len(dims_field_lo) > 3:
         logging.critical("You have more than 3 dimensions. I have no idea what to do")
         sys.exit("catastrophe! goodbye...")
-    dims_elev_hi = elev_hi.squeeze().shape
-    dims_elev_lo = elev_lo.squeeze().shape
+    if statics is None:
+        statics = downscale_statics(elev_hi, elev_lo, mask, half_a_box)
+    LY, LX = statics["shape"]
     need_time = True
-    if len(dims_elev_hi) != len(dims_elev_lo):
-        logging.critical("The orography fields have different dimensions, you need to fix this!")
-        logging.critical("High resolution is: " + str(dims_elev_hi))
-        logging.critical("Lo resolution is: " + str(dims_elev_lo))
-        sys.exit("catastrophe! goodbye...")
-    if len(dims_field_lo) == len(dims_elev_hi):
+    if dims_field_lo == (LY, LX):
         need_time = False
-    elif (len(dims_field_lo) != len(dims_elev_hi)) and (dims_field_lo[1] == dims_elev_hi[0]):
+    elif len(dims_field_lo) == 3 and dims_field_lo[1:] == (LY, LX):
         logging.warning("You probably have a time variable! I will try to loop over it")
     else:
         logging.critical("The field you are downscaling doesn't have the time dimension as the 1st dimension, this needs to be fixed!")
-        sys.exit("catastrophe! goodbye...")    
-    field_hi = np.empty(field_lo.shape) * np.nan
-    half_a_box_y = round(0.8 * half_a_box)
-    half_a_box_x = round(half_a_box)
-    logging.warning("Half a box x and y are: (%s, %s)" % (half_a_box_x, half_a_box_y))
-    LY, LX = np.shape(mask)
-    logging.info("Shape will be %s,  %s" % (LY, LX))
-    i_range = range(int(half_a_box_y), int(LY-half_a_box_y))
-    j_range = range(int(half_a_box_x), int(LX-half_a_box_x))
-    logging.debug("i_range is "+str(i_range))
-    logging.debug("j_range is "+str(j_range))
-    counter = 0
-    if not need_time:
-        for j in j_range:
-            for i in i_range:
-                logging.info("Working on index (%s, %s)" % (i, j))
-                logging.debug("Mask value is: %s" % (mask[i, j]))
-                if mask[i, j] > 0:
-                    logging.debug("PASSED MASK SELECTION")
-                    logging.debug("i slice is: %s to %s" % (i-half_a_box_y, i+half_a_box_y))
-                    logging.debug("j slice is: %s to %s" % (j-half_a_box_x, j+half_a_box_x))
-                    min_elev_lo = np.nanmin(
-                        elev_lo[i-half_a_box_y:i+half_a_box_y, j-half_a_box_x:j+half_a_box_x])
-                    max_elev_lo = np.nanmax(
-                        elev_lo[i-half_a_box_y:i+half_a_box_y, j-half_a_box_x:j+half_a_box_x])
-
-                    min_elev_hi = np.nanmin(
-                        elev_hi[i-half_a_box_y:i+half_a_box_y, j-half_a_box_x:j+half_a_box_x])
-                    max_elev_hi = np.nanmax(
-                        elev_hi[i-half_a_box_y:i+half_a_box_y, j-half_a_box_x:j+half_a_box_x])
-
-                    min_field_lo = np.nanmin(
-                        field_lo[i-half_a_box_y:i+half_a_box_y, j-half_a_box_x:j+half_a_box_x])
-                    max_field_lo = np.nanmax(
-                        field_lo[i-half_a_box_y:i+half_a_box_y, j-half_a_box_x:j+half_a_box_x])
-
-                    if j == (half_a_box_x):
-                        bottom_k = -half_a_box_x
-                        top_k = 0
-                    elif j == (LX - half_a_box_x - 1):
-                        bottom_k = 0
-                        top_k = half_a_box_x
-                    else:
-                        bottom_k = 0
-                        top_k = 0
-
-                    if i == (half_a_box_y):
-                        left_l = -half_a_box_y
-                        right_l = 0
-                    elif i == (LY - half_a_box_y - 1):
-                        left_l = 0
-                        right_l = half_a_box_y
-                    else:
-                        left_l = 0
-                        right_l = 0
-                else:
-                    # Something about the mask didn't work
-                    logging.debug("Mask not used at (%s, %s)" % (i, j))
-                    left_l = 0
-                    right_l = 0
-                    top_k = 0
-                    bottom_k = 0 
-
-                for k in np.arange(bottom_k, top_k+1):
-                    for l in np.arange(left_l, right_l+1):
-                        if mask[i+l, j+k] > 0:
-                            if (max_elev_lo == min_elev_lo):
-                                field_hi[i+l, j+k] = field_lo[i+l, j+k]
-                            else:
-                                lapse_lo = (min_field_lo - max_field_lo)/(max_elev_lo - min_elev_lo)
-                                field_hi[i+l, j+k] = lapse_lo * (elev_hi[i+l, j+k] - elev_lo[i+l, j+k]) + field_lo[i+l, j+k]
+        sys.exit("catastrophe! goodbye...")
+    field_lo = field_lo.reshape(dims_field_lo)
+    if out is None:
+        field_hi = np.full(dims_field_lo, np.nan, dtype=dtype)
     else:
-        for t in range(dims_field_lo[0]):
-            logging.debug("WORKING ON TIMESTEP %s" % t)
-            for j in j_range:
-                for i in i_range:
-                    logging.info("Working on index (%s, %s)" % (i, j))
-                    logging.debug("Mask value is: %s" % (mask[i, j]))
-                    if mask[i, j] > 0:
-                        logging.debug("PASSED MASK SELECTION")
-                        logging.debug("i slice is: %s to %s" % (i-half_a_box_y, i+half_a_box_y))
-                        logging.debug("j slice is: %s to %s" % (j-half_a_box_x, j+half_a_box_x))
-                        min_elev_lo = np.nanmin(
-                            elev_lo[i-half_a_box_y:i+half_a_box_y, j-half_a_box_x:j+half_a_box_x])
-                        max_elev_lo = np.nanmax(
-                            elev_lo[i-half_a_box_y:i+half_a_box_y, j-half_a_box_x:j+half_a_box_x])
-
-                        min_elev_hi = np.nanmin(
-                            elev_hi[i-half_a_box_y:i+half_a_box_y, j-half_a_box_x:j+half_a_box_x])
-                        max_elev_hi = np.nanmax(
-                            elev_hi[i-half_a_box_y:i+half_a_box_y, j-half_a_box_x:j+half_a_box_x])
-
-                        min_field_lo = np.nanmin(
-                            field_lo[t, i-half_a_box_y:i+half_a_box_y, j-half_a_box_x:j+half_a_box_x])
-                        max_field_lo = np.nanmax(
-                            field_lo[t, i-half_a_box_y:i+half_a_box_y, j-half_a_box_x:j+half_a_box_x])
-
-                        if j == (half_a_box_x):
-                            bottom_k = -half_a_box_x
-                            top_k = 0
-                        elif j == (LX - half_a_box_x - 1):
-                            bottom_k = 0
-                            top_k = half_a_box_x
-                        else:
-                            bottom_k = 0
-                            top_k = 0
-
-                        if i == (half_a_box_y):
-                            left_l = -half_a_box_y
-                            right_l = 0
-                        elif i == (LY - half_a_box_y - 1):
-                            left_l = 0
-                            right_l = half_a_box_y
-                        else:
-                            left_l = 0
-                            right_l = 0
-                    else:
-                        # Something about the mask didn't work
-                        logging.debug("Mask not used at (%s, %s)" % (i, j))
-                        left_l = 0
-                        right_l = 0
-                        top_k = 0
-                        bottom_k = 0 
-
-                    for k in np.arange(bottom_k, top_k+1):
-                        for l in np.arange(left_l, right_l+1):
-                            if mask[i+l, j+k] > 0:
-                                if (max_elev_lo == min_elev_lo):
-                                    field_hi[t, i+l, j+k] = field_lo[t, i+l, j+k]
-                                else:
-                                    lapse_lo = (min_field_lo - max_field_lo)/(max_elev_lo - min_elev_lo)
-                                    field_hi[t, i+l, j+k] = lapse_lo * (elev_hi[i+l, j+k] - elev_lo[i+l, j+k]) + field_lo[t, i+l, j+k]
-    if (counter > 0):
-        logging.warning("Neither condition was used %s times" % counter)
+        if out.shape != dims_field_lo:
+            logging.critical("The output array has shape %s, the field %s" % (out.shape, dims_field_lo))
+            sys.exit("catastrophe! goodbye...")
+        # Filled in place, a memory mapped array stays on disk
+        field_hi = out
+        field_hi.fill(np.nan)
+    target = statics["target"]
+    center_i, center_j = statics["center_i"], statics["center_j"]
+    elev_range = statics["elev_range"]
+    flat = elev_range == 0
+    size = (2 * statics["half_a_box_y"], 2 * statics["half_a_box_x"])
+    for t in range(dims_field_lo[0] if need_time else 1):
+        this_field_lo = field_lo[t] if need_time else field_lo
+        this_field_hi = field_hi[t] if need_time else field_hi
+        logging.debug("WORKING ON TIMESTEP %s" % t)
+        min_field_lo, max_field_lo = _window_min_max(this_field_lo, size)
+        field_range = (min_field_lo[center_i, center_j] - max_field_lo[center_i, center_j])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            lapse_lo = field_range / elev_range
+        this_field_lo = this_field_lo[target]
+        this_field_hi[target] = np.where(flat, this_field_lo,
+                                         lapse_lo * statics["delta_elev"] + this_field_lo)
+    profiling.count("cells_processed",
+                    int(np.count_nonzero(target)) * (dims_field_lo[0] if need_time else 1))
     logging.info("Finished! Time was %s" % str(time.time()-now))
     return field_hi
 
@@ -271,6 +249,8 @@ def main():
     hdlr.setFormatter(fmt)
     logging.root.addHandler(hdlr)
     logging.root.setLevel(args.loglevel)
+    if args.profile:
+        profiling.enable()
 
     T_lo_varname = "TT"
     H_lo_varname = "SH"
@@ -280,13 +260,16 @@ def main():
     # Make the output file:
     shutil.copy(args.ifile_lo, args.ofilename)
 
-    T_lo = netcdf.netcdf_file(args.ifile_lo).variables[T_lo_varname].data[6, -1, :, :].squeeze()
-    T_or = netcdf.netcdf_file(args.ifile_hi).variables[T_lo_varname].data[6, -1, :, :].squeeze()
-    H_lo = netcdf.netcdf_file(args.ifile_lo).variables[H_lo_varname].data.squeeze()
+    with profiling.timer("read inputs", "read"):
+        T_lo = netcdf.netcdf_file(args.ifile_lo).variables[T_lo_varname].data[6, -1, :, :].squeeze()
+        T_or = netcdf.netcdf_file(args.ifile_hi).variables[T_lo_varname].data[6, -1, :, :].squeeze()
+        H_lo = netcdf.netcdf_file(args.ifile_lo).variables[H_lo_varname].data.squeeze()
 
-    H_hi = netcdf.netcdf_file(args.ifile_hi).variables[H_hi_varname].data.squeeze()
-    mask = netcdf.netcdf_file(args.ifile_hi).variables[mask_varname].data.squeeze()
-    T_hi = downscale_field(T_lo, H_hi, H_lo, mask, half_a_box=20)
+        H_hi = netcdf.netcdf_file(args.ifile_hi).variables[H_hi_varname].data.squeeze()
+        mask = netcdf.netcdf_file(args.ifile_hi).variables[mask_varname].data.squeeze()
+    profiling.count("bytes_read", T_lo.nbytes + T_or.nbytes + H_lo.nbytes + H_hi.nbytes + mask.nbytes)
+    with profiling.timer("downscale_field", "compute"):
+        T_hi = downscale_field(T_lo, H_hi, H_lo, mask, half_a_box=20)
 
     # TODO: Write ofile to netcdf
     
@@ -313,6 +296,9 @@ def main():
 
         plt.show()
 
+    if args.profile:
+        profiling.write_trace(args.profile)
+
 if __name__ == '__main__':
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
@@ -0,0 +1,153 @@
+#!/bin/bash
+
+# Grid-sequencing spinup driver around spinup.sh.
+#
+# Runs a staged spinup from coarse to fine resolution. Every stage
+# bootstraps from BOOTFILE and regrids the state variables from the
+# previous stage's output, so the expensive fine grids only have to run
+# for a short time. PROCS is the process count of the finest (last)
+# stage; earlier stages get a share proportional to their number of grid
+# points. -skip_max is scaled with the grid spacing.
+
+set -e  # exit on error
+
+SCRIPTDIR=$(cd "$(dirname "$0")" && pwd)
+
+if [ $# -lt 4 ] ; then
+  echo "grid_sequence.sh ERROR: needs 4 or 5 or 6 positional arguments ... ENDING NOW"
+  echo
+  echo "usage:"
+  echo
+  echo "    grid_sequence.sh PROCS CLIMATE DYNAMICS PLAN [PREFIX] [BOOTFILE]"
+  echo
+  echo "  where:"
+  echo "    PROCS     = 1,2,3,... is number of MPI processes for the finest stage,"
+  echo "                or auto to let spinup.sh choose it for every stage (needs PERFLOG)"
+  echo "    CLIMATE   is passed on to spinup.sh"
+  echo "    DYNAMICS  is passed on to spinup.sh"
+  echo "    PLAN      comma separated list of GRID:DURATION stages, coarse to fine"
+  echo "    PREFIX    optional prefix of output files; default = gridseq"
+  echo "    BOOTFILE  optional name of input file; default is the spinup.sh default"
+  echo
+  echo "consider setting optional environment variables:"
+  echo "    REGRIDVARS   desired -regrid_vars for all but the first stage;"
+  echo "                   defaults to the spinup.sh default"
+  echo "    SKIPMAX_KM   -skip_max is SKIPMAX_KM / GRID, defaults to 200"
+  echo "                   (i.e. 10 at 20 km, 40 at 5 km)"
+  echo "    all other spinup.sh variables (PISM_DO, PISM_MPIDO, EXSTEP, ...)"
+  echo
+  echo "example usage:"
+  echo
+  echo "    $ ./grid_sequence.sh 288 const hybrid 20:50000,10:5000,5:500 g"
+  echo
+  echo "  Runs 50000 years at 20 km on 18 processes, 5000 years at 10 km on 72"
+  echo "  processes and 500 years at 5 km on 288 processes, writing g_20km.nc,"
+  echo "  g_10km.nc and g_5km.nc."
+  echo
+  echo "  Stages that finished (marked by <output file>.done) are skipped, so a"
+  echo "  killed sequence can be resubmitted unchanged."
+  echo
+  exit
+fi
+
+SCRIPTNAME="#(grid_sequence.sh)"
+NN="$1"
+CLIMATE="$2"
+DYNAMICS="$3"
+PLAN=$(echo "$4" | tr ',' ' ')
+PREFIX=${5:-gridseq}
+BOOTFILE="$6"
+
+# spinup.sh ends with status 0 on these, so check them before any stage
+case $CLIMATE in
+  const|paleo) ;;
+  *)
+    echo "$SCRIPTNAME invalid CLIMATE $CLIMATE; must be const or paleo ... ENDING NOW"
+    exit 1
+esac
+case $DYNAMICS in
+  sia|hybrid) ;;
+  *)
+    echo "$SCRIPTNAME invalid DYNAMICS $DYNAMICS; must be sia or hybrid ... ENDING NOW"
+    exit 1
+esac
+
+if [ -z "${SKIPMAX_KM}" ] ; then  # check if env var is NOT set
+  SKIPMAX_KM=200
+fi
+
+# number of grid points (Mx * My) for each grid in spinup.sh
+function grid_points {
+  case $1 in
+    40) echo $((38 * 71)) ;;
+    20) echo $((76 * 141)) ;;
+    10) echo $((151 * 281)) ;;
+    5) echo $((301 * 561)) ;;
+    3) echo $((501 * 934)) ;;
+    2) echo $((750 * 1400)) ;;
+    *)
+      echo "$SCRIPTNAME invalid grid $1 in plan" >&2
+      exit 1
+  esac
+}
+
+# the finest stage is the last one
+for STAGE in $PLAN; do
+  FINEST=${STAGE%%:*}
+done
+FINESTPOINTS=$(grid_points $FINEST)
+
+echo
+echo "# ======================================================================="
+echo "# PISM grid sequencing spinup:"
+echo "#    plan $4, $NN processors at $FINEST km"
+echo "# ======================================================================="
+
+PREVIOUS=""
+PREVIOUSDX=""
+for STAGE in $PLAN; do
+  DX=${STAGE%%:*}
+  DURATION=${STAGE##*:}
+  if [ -n "$PREVIOUSDX" ] && [ "$DX" -gt "$PREVIOUSDX" ] ; then
+    echo "$SCRIPTNAME WARNING: stage $DX km is coarser than the previous one ($PREVIOUSDX km)"
+  fi
+  OUTNAME=${PREFIX}_${DX}km.nc
+  # processes scale with the number of grid points, rounded, at least 1
+  POINTS=$(grid_points $DX)
+  if [ "$NN" = "auto" ] ; then
+    PROCS=auto
+  else
+    PROCS=$(( (NN * POINTS + FINESTPOINTS / 2) / FINESTPOINTS ))
+    if [ "$PROCS" -lt 1 ] ; then
+      PROCS=1
+    fi
+  fi
+  SKIP=$(( SKIPMAX_KM / DX ))
+  if [ "$SKIP" -lt 1 ] ; then
+    SKIP=1
+  fi
+
+  echo "$SCRIPTNAME  stage $DX km: $DURATION a, $PROCS processors, skip_max $SKIP -> $OUTNAME"
+  # PISM also writes $OUTNAME when it is killed at the wall time limit,
+  # so only the marker written after a successful run counts
+  if [ -e "${OUTNAME}.done" ] ; then
+    echo "$SCRIPTNAME  ${OUTNAME}.done exists, skipping stage"
+  else
+    if [ -n "$PREVIOUS" ] ; then
+      REGRIDFILE=$PREVIOUS SKIPMAX=$SKIP SCRIPTNAME="$SCRIPTNAME" \
+        $SCRIPTDIR/spinup.sh $PROCS $CLIMATE $DURATION $DX $DYNAMICS $OUTNAME $BOOTFILE
+    else
+      REGRIDFILE="" SKIPMAX=$SKIP SCRIPTNAME="$SCRIPTNAME" \
+        $SCRIPTDIR/spinup.sh $PROCS $CLIMATE $DURATION $DX $DYNAMICS $OUTNAME $BOOTFILE
+    fi
+    # set -e: only reached if spinup.sh returned 0, which it also does
+    # when it gives up before running PISM, so $OUTNAME has to exist
+    if [ -z "${PISM_DO}" ] && [ -f "$OUTNAME" ] ; then
+      touch ${OUTNAME}.done
+    else
+      echo "$SCRIPTNAME  $OUTNAME was not written, stage not marked done"
+    fi
+  fi
+  PREVIOUS=$OUTNAME
+  PREVIOUSDX=$DX
+done
@@ -14,3 +14,5 @@ do
 done
 
 cat ${HOME}/palmod_pism_standalone/scripts/run_script_template.sh |sed s+@EXPNAME@+"${expid}"+g > $expid/${SCRIPTDIR}/${expid}.run
+cp -v ${HOME}/palmod_pism_standalone/scripts/postprocess_segments.py $expid/${SCRIPTDIR}/
+cp -v ${HOME}/palmod_pism_standalone/scripts/tune_allocation.py $expid/${SCRIPTDIR}/
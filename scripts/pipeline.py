@@ -0,0 +1,201 @@
+# coding: utf-8
+"""
+Overlapping reads, computation and writes of time chunks.
+
+Most steps in pism_input_from_gcm.py read a chunk of time records,
+compute something with it and write the result. Done one after the
+other, the CPU waits for the file system and the file system waits for
+the CPU. chunk_pipeline runs the reads in one background thread and the
+writes in another, so while chunk N is computed in the calling thread,
+chunk N+1 is already being read and chunk N-1 written. At most depth
+chunks wait between two stages and, if max_bytes is given, no new chunk
+is read while the chunks in flight (read, computed or waiting to be
+written) take up more than max_bytes. numpy, scipy.ndimage and the file
+reads release the GIL, so the stages really run at the same time.
+
+Usage:
+
+    import pipeline
+
+    def read(key):
+        t0, t1 = key
+        return fin["temp2"][t0:t1]
+
+    def compute(key, t):
+        return t - 273.15
+
+    def write(key, t):
+        t0, t1 = key
+        out[t0:t1] = t
+
+    pipeline.chunk_pipeline(read, compute, write).run(pipeline.time_chunks(len(fin["temp2"]), 12))
+
+An exception in any stage stops the pipeline and is raised again in the
+calling thread.
+"""
+
+import logging
+import sys
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import profiling
+
+_DONE = object()
+
+
+##########
+# CLASSES
+##########
+
+class chunk_pipeline(object):
+    """
+    Keyword Arguments:
+    read      -- read(key) returns the input of one chunk
+    compute   -- compute(key, data) returns the result of one chunk, runs in the calling thread
+    write     -- (default None) write(key, result) stores the result, None if nothing is written
+    depth     -- (default 2) chunks that may wait between two stages
+    max_bytes -- (default None) memory budget for all chunks in flight, None for no limit
+    """
+    def __init__(self, read, compute, write=None, depth=2, max_bytes=None):
+        self.read = read
+        self.compute = compute
+        self.write = write
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self._in_flight = 0
+        self._budget = threading.Condition()
+        self._error = None
+
+    def _acquire(self, nbytes):
+        with self._budget:
+            self._in_flight += nbytes
+
+    def _release(self, nbytes):
+        with self._budget:
+            self._in_flight -= nbytes
+            self._budget.notify_all()
+
+    def _wait_for_budget(self):
+        # One chunk is always allowed, however large it is
+        with self._budget:
+            while (self.max_bytes is not None and self._in_flight > 0 and
+                   self._in_flight >= self.max_bytes and self._error is None):
+                self._budget.wait(0.1)
+
+    def _fail(self, stage):
+        if self._error is None:
+            self._error = sys.exc_info()
+            logging.error("%s stage of the pipeline failed: %s" % (stage, self._error[1]))
+        with self._budget:
+            self._budget.notify_all()
+
+    def _put(self, q, item):
+        # Gives up when another stage failed, nobody would take the item
+        while self._error is None:
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, q):
+        while self._error is None:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _reader(self, keys, read_queue):
+        try:
+            for key in keys:
+                self._wait_for_budget()
+                if self._error is not None:
+                    return
+                with profiling.timer("read chunk %s" % (key,), "read"):
+                    data = self.read(key)
+                nbytes = _nbytes(data)
+                self._acquire(nbytes)
+                self._put(read_queue, (key, data, nbytes))
+        except Exception:
+            self._fail("read")
+        finally:
+            self._put(read_queue, _DONE)
+
+    def _writer(self, write_queue):
+        try:
+            while True:
+                item = self._get(write_queue)
+                if item is _DONE:
+                    return
+                key, result, nbytes = item
+                with profiling.timer("write chunk %s" % (key,), "write"):
+                    self.write(key, result)
+                del result
+                self._release(nbytes)
+        except Exception:
+            self._fail("write")
+
+    def run(self, keys):
+        """Reads, computes and writes all chunks in keys; returns the results if nothing is written."""
+        read_queue = queue.Queue(maxsize=self.depth)
+        write_queue = queue.Queue(maxsize=self.depth)
+        reader = threading.Thread(target=self._reader, args=(keys, read_queue))
+        reader.daemon = True
+        reader.start()
+        writer = None
+        if self.write is not None:
+            writer = threading.Thread(target=self._writer, args=(write_queue,))
+            writer.daemon = True
+            writer.start()
+        results = []
+        try:
+            while True:
+                item = self._get(read_queue)
+                if item is _DONE:
+                    break
+                key, data, nbytes = item
+                with profiling.timer("compute chunk %s" % (key,), "compute"):
+                    result = self.compute(key, data)
+                del data
+                profiling.count("pipeline_chunks")
+                if writer is None:
+                    results.append((key, result))
+                    self._release(nbytes)
+                    continue
+                result_bytes = _nbytes(result)
+                self._acquire(result_bytes)
+                self._release(nbytes)
+                self._put(write_queue, (key, result, result_bytes))
+        except Exception:
+            self._fail("compute")
+        finally:
+            if writer is not None:
+                self._put(write_queue, _DONE)
+                writer.join()
+            reader.join()
+        if self._error is not None:
+            raise self._error[1]
+        return results
+
+
+############
+# FUNCTIONS
+############
+
+def time_chunks(ntime, chunk_records):
+    """The (t0, t1) keys of ntime records in chunks of chunk_records."""
+    return [(t0, min(t0 + chunk_records, ntime)) for t0 in range(0, ntime, chunk_records)]
+
+
+def _nbytes(data):
+    """Bytes held by an array, or a tuple/list/dict of arrays."""
+    if isinstance(data, dict):
+        data = list(data.values())
+    if isinstance(data, (tuple, list)):
+        return sum(_nbytes(d) for d in data)
+    return getattr(data, "nbytes", 0)
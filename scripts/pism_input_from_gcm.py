@@ -6,27 +6,51 @@
 #################
 
 import argparse
+import collections
 import datetime
+import hashlib
+import json
 import logging
+import numpy as np
 from scipy.io import netcdf
 import os
 import shutil
+import socket
 import sys
+import threading
+import time
 import warnings
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
 
+import checkpoint
+import pipeline
+import profiling
 
 try:
-    from downscale_field import downscale_field
+    from downscale_field import downscale_field, downscale_statics
     downscale_available = True
 except ImportError:
     print "downscale_field.py not found, downscaling will be disabled"
     downscale_available = False
+try:
+    from sparse_remap import remap_operator, read_grid, grid_hash, cell_edges, projected_cell_area
+    sparse_remap_available = True
+except ImportError:
+    print "sparse_remap.py not found, only cdo remapping will be available"
+    sparse_remap_available = False
 try:
     import cdo
+    cdo_available = True
 except ImportError:
-    raise ImportError(
-        "cdo-python interface could not be found. " +
-        "Try installing it via: \n pip install --user cdo")
+    if not sparse_remap_available:
+        raise ImportError(
+            "cdo-python interface could not be found. " +
+            "Try installing it via: \n pip install --user cdo")
+    print "cdo-python interface not found, only --engine sparse remapping will be available"
+    cdo_available = False
 try:
     import nco
 except ImportError:
@@ -103,6 +127,18 @@ def _parse_file_and_var(s):
         raise argparse.ArgumentTypeError("Must be given as: filename, varname")
 
 
+def _parse_downscale_variable(s):
+    parts = s.split(',')
+    if not 2 <= len(parts) <= 4:
+        raise argparse.ArgumentTypeError("Must be given as: filename,varname[,outname[,method]]")
+    f, v = parts[:2]
+    outname = parts[2] if len(parts) > 2 and parts[2] else v + "_downscaled"
+    method = parts[3] if len(parts) > 3 else "lapse"
+    if method not in ("lapse", "none"):
+        raise argparse.ArgumentTypeError("Downscaling method must be lapse or none, not " + method)
+    return f, v, outname, method
+
+
 def parse_arguments():
     """
     This function looks scary. It just gets command line arguments
@@ -120,6 +156,8 @@ def parse_arguments():
                         default=logging.WARNING)
     parser.add_argument("-v", "--verbose", help="increase output verbosity",
                         action="store_const", dest="loglevel", const=logging.INFO)
+    parser.add_argument("--profile", metavar="FILE", default=None,
+                        help="write a timing/counter trace (Chrome trace JSON) to FILE, e.g. profile.json")
     subparsers = parser.add_subparsers(dest="command")
     ##########################################################################
     remap_parser_group = subparsers.add_parser("remap",
@@ -130,6 +168,10 @@ def parse_arguments():
     remap_parser_group.add_argument('-igrid', '--ifile_griddes',
                                     required=True,
                                     help="The grid description you want to use, either built into CDO directly, or from a griddes file")
+    remap_parser_group.add_argument("-e", "--engine", choices=["cdo", "sparse"], default="cdo",
+                                    help="cdo (default) or sparse: in-process sparse matrix remapping, needs the cell corners (griddes file with xbounds/ybounds, SCRIP grid file or PISM_xbounds_*); approximately conservative only, not equivalent to cdo remapcon")
+    remap_parser_group.add_argument("-w", "--weights",
+                                    help="Weights for --engine sparse: a SCRIP/cdo weight file (.nc) or a saved operator (.npz), computed and saved as .npz if missing")
     ##########################################################################
     interpolate_parser_group = subparsers.add_parser("interpolate",
                                                      help="Interpolates a field via cdo remapbil, works similarly to remap command")
@@ -139,12 +181,21 @@ def parse_arguments():
     interpolate_parser_group.add_argument('-igrid', '--ifile_griddes',
                                           required=True,
                                           help="The grid description you want to use, either built into CDO directly, or from a griddes file")
+    interpolate_parser_group.add_argument("-e", "--engine", choices=["cdo", "sparse"], default="cdo",
+                                          help="cdo (default) or sparse: in-process sparse matrix remapping from a griddes file, SCRIP grid file or PISM_xbounds_*")
+    interpolate_parser_group.add_argument("-w", "--weights",
+                                          help="Weights for --engine sparse: a SCRIP/cdo weight file (.nc) or a saved operator (.npz), computed and saved as .npz if missing")
     ##########################################################################
     downscale_parser_group = subparsers.add_parser("downscale",
                                                    help="Options that need to be provided for downscaling of GCM outputs to fine grids")
     downscale_parser_group.add_argument("-dgcm", "--downscale_gcm",
                                         type=_parse_file_and_var,
-                                        help="Downscale (file,variable) with low resolution (target) field")
+                                        help="Downscale (file,variable) with low resolution (target) field, written as air_temp_downscaled")
+    downscale_parser_group.add_argument("-dvar", "--downscale_variable",
+                                        type=_parse_downscale_variable, action="append",
+                                        help="Downscale (file,variable[,outname[,method]]), can be given several times. " +
+                                        "outname defaults to variable_downscaled, method to lapse (or none: copy unchanged). " +
+                                        "All variables share one set of orography statistics and go into one output file")
     downscale_parser_group.add_argument("-dhires", "--downscale_hires",
                                         type=_parse_file_and_var,
                                         help="Downscale (file,variable) with high resolution (target) orography")
@@ -155,8 +206,11 @@ def parse_arguments():
                                         type=_parse_file_and_var,
                                         help="Downscale mask (file,variable)")
     downscale_parser_group.add_argument("-dhab", "--downscale_half_a_box",
-                                        type=int,
-                                        help="Downscale half_a_box")
+                                        type=int, default=50,
+                                        help="Downscale half_a_box, defaults to 50")
+    downscale_parser_group.add_argument("-ddtype", "--downscale_dtype",
+                                        choices=["float32", "float64"], default="float32",
+                                        help="Precision of the downscaled fields, defaults to float32 (that of the GCM output)")
 
     ##########################################################################
     ##########################################################################
@@ -216,6 +270,66 @@ def parse_arguments():
     
     ##########################################################################
     ##########################################################################
+    export_parser_group = subparsers.add_parser("export_to_gcm",
+                                                help="Aggregates PISM output conservatively to the GCM grid and writes the orography and glacier mask for ECHAM")
+    export_parser_group.add_argument("-ipism", "--ifile_pism",
+                                     required=True,
+                                     help="The PISM output (e.g. -extra_file) to aggregate")
+    export_parser_group.add_argument("-igcm", "--ifile_gcm_template",
+                                     required=True,
+                                     help="An ECHAM surface file (e.g. *_jan_surf.nc) on the target grid, used as template")
+    export_parser_group.add_argument("-igrid", "--ifile_pism_grid",
+                                     help="File with the 2D lat/lon of the PISM grid, defaults to the PISM output itself")
+    export_parser_group.add_argument("-w", "--weights",
+                                     help="Sparse aggregation weights (.npz); computed and saved here if missing")
+    export_parser_group.add_argument("--variables", default="thk,usurf,climatic_mass_balance_cumulative",
+                                     help="Comma separated PISM variables to area-average, defaults to thk,usurf,climatic_mass_balance_cumulative (the mask goes into ice_fraction)")
+    export_parser_group.add_argument("--oro_varname", default="OROMEA",
+                                     help="Orography variable in the ECHAM file, defaults to OROMEA")
+    export_parser_group.add_argument("--glac_varname", default="GLAC",
+                                     help="Glacier mask variable in the ECHAM file, defaults to GLAC")
+    export_parser_group.add_argument("-oecham", "--ofile_echam", default="echam_surf_from_pism.nc",
+                                     help="The ECHAM surface file with updated orography and glacier mask, defaults to echam_surf_from_pism.nc")
+    ##########################################################################
+    serve_parser_group = subparsers.add_parser("serve",
+                                               help="Runs as a resident service preparing \"given\" atmosphere forcing for coupled runs, requests come in over a Unix socket")
+    serve_parser_group.add_argument("pism_ifile", help="The pism input file the forcing will be used with")
+    serve_parser_group.add_argument("-s", "--socket", required=True,
+                                    help="The Unix socket to listen on")
+    serve_parser_group.add_argument('-igrid', '--ifile_griddes',
+                                    required=True,
+                                    help="The grid description of the PISM grid, either built into CDO directly, or from a griddes file")
+    serve_parser_group.add_argument("-m", "--remap_method", choices=["con", "bil"], default="con",
+                                    help="cdo remapping method, con (1st order conservative, default) or bil (bilinear)")
+    serve_parser_group.add_argument("-w", "--workdir", default="forcing_service",
+                                    help="Directory for weights and temporary files, defaults to ./forcing_service")
+    serve_parser_group.add_argument("-dhires", "--downscale_hires",
+                                    type=_parse_file_and_var,
+                                    help="Downscale temperature with this (file,variable) high resolution orography")
+    serve_parser_group.add_argument("-dlores", "--downscale_lores",
+                                    type=_parse_file_and_var,
+                                    help="Downscale (file,variable) with low resolution (original) orography")
+    serve_parser_group.add_argument("-dmask", "--downscale_mask",
+                                    type=_parse_file_and_var,
+                                    help="Downscale mask (file,variable)")
+    serve_parser_group.add_argument("-dhab", "--downscale_half_a_box",
+                                    type=int, default=50,
+                                    help="Downscale half_a_box, defaults to 50")
+    ##########################################################################
+    request_parser_group = subparsers.add_parser("request",
+                                                 help="Asks a running service (see serve) to prepare forcing, prints the path of the PISM-ready file")
+    request_parser_group.add_argument("-s", "--socket", required=True,
+                                      help="The Unix socket the service listens on")
+    request_parser_group.add_argument("ifile_gcm", nargs="?",
+                                      help="The GCM output file to prepare forcing from")
+    request_parser_group.add_argument("ofile_forcing", nargs="?",
+                                      help="Where to put the PISM-ready forcing file")
+    request_parser_group.add_argument("--tempvarname", default="temp2",
+                                      help="Temperature variable in the GCM file, defaults to temp2")
+    request_parser_group.add_argument("--precipvarname", default="aprs",
+                                      help="Precipitation variable in the GCM file, defaults to aprs")
+    request_parser_group.add_argument("--shutdown", action="store_true",
+                                      help="Stop the service instead")
     ##########################################################################
     return parser.parse_args()
 
@@ -225,85 +339,735 @@ def parse_arguments():
 ##########
 
 class pism_output_file(object):
-    # Something something
-    pass
+    """
+    Lazy view of a netCDF file.
+
+    Open files with pism_output_file.open(filename): every file gets one
+    handle, however often (and from wherever) it is asked for. Nothing is
+    read when the file is opened; f["temp2"] only looks up the variable,
+    and data is read when the variable is indexed, one chunk of
+    chunk_records time records (or the whole variable, if it has no record
+    dimension) at a time. Chunks are kept in an LRU cache of at most
+    cache_bytes, so repeated or partial accesses do not hit the disk again.
+    f["temp2"].read() explicitly materializes the whole variable.
+
+    New variables and global attributes are collected with
+    create_variable() and set_attributes() and written back in one go by
+    flush() (or close()). A new variable changes the header and the layout
+    of a netCDF-3 file, so flush() writes the file anew, once per file and
+    not once per variable: the existing variables are copied record by
+    record from the mapped old file, which is replaced when the new one is
+    complete. Variables created without data are only laid out in the
+    file, without being allocated in memory; writable() then maps them
+    read/write, so they can be filled chunk by chunk.
+    """
+    _open_files = {}
+
+    def __init__(self, filename, chunk_records=12, cache_bytes=512 * 2**20):
+        self.filename = filename
+        self.chunk_records = chunk_records
+        self.cache_bytes = cache_bytes
+        self._handle = None
+        self._variables = {}
+        self._cache = collections.OrderedDict()
+        self._cached_bytes = 0
+        self._pending_variables = []
+        self._pending_attributes = {}
+        self._mapped = []
+        # Chunks may be read from a pipeline thread
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, filename, **kwargs):
+        """Returns the handle of filename, creating it on first use."""
+        key = os.path.abspath(filename)
+        if key not in cls._open_files:
+            cls._open_files[key] = cls(filename, **kwargs)
+        f = cls._open_files[key]
+        for name, value in kwargs.items():
+            if getattr(f, name) != value:
+                raise ValueError("%s is already open with %s=%s, not %s"
+                                 % (filename, name, getattr(f, name), value))
+        return f
+
+    @property
+    def handle(self):
+        if self._handle is None:
+            # mmap: only the pages actually indexed are read
+            self._handle = netcdf.netcdf_file(self.filename, "r", mmap=True)
+        return self._handle
+
+    def __getattr__(self, name):
+        # Global attributes (source, history, ...)
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.handle, name)
+
+    def __contains__(self, name):
+        return name in self.handle.variables
+
+    @property
+    def attributes(self):
+        return self.handle._attributes
+
+    def __getitem__(self, name):
+        if name not in self._variables:
+            if name not in self.handle.variables:
+                raise KeyError("%s has no variable %s" % (self.filename, name))
+            self._variables[name] = pism_variable(self, name)
+        return self._variables[name]
+
+    @property
+    def variables(self):
+        return dict((name, self[name]) for name in self.handle.variables)
+
+    @property
+    def dimensions(self):
+        return self.handle.dimensions
+
+    def _chunk(self, name, k):
+        key = (name, k)
+        if key in self._cache:
+            # Move to the most recently used end
+            chunk = self._cache.pop(key)
+            self._cache[key] = chunk
+            profiling.count("cache_hits")
+            return chunk
+        profiling.count("cache_misses")
+        var = self.handle.variables[name]
+        with profiling.timer("read %s chunk %s" % (name, k), "read"):
+            if self[name].is_record:
+                chunk = np.array(var.data[k * self.chunk_records:(k + 1) * self.chunk_records])
+            else:
+                chunk = np.array(var.data)
+        profiling.count("bytes_read", chunk.nbytes)
+        # Callers get views of the cached chunks, which must stay unchanged
+        chunk.flags.writeable = False
+        self._cache[key] = chunk
+        self._cached_bytes += chunk.nbytes
+        # Always keep the chunk just read, even if it is larger than the cache
+        while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+            old_key, old_chunk = self._cache.popitem(last=False)
+            self._cached_bytes -= old_chunk.nbytes
+        return chunk
+
+    def read_records(self, name, t0, t1):
+        """Records t0 (inclusive) to t1 (exclusive) of a record variable, through the cache."""
+        with self._lock:
+            return self._read_records(name, t0, t1)
+
+    def _read_records(self, name, t0, t1):
+        if not self[name].is_record:
+            return self._chunk(name, None)[t0:t1]
+        k0 = t0 // self.chunk_records
+        k1 = (t1 - 1) // self.chunk_records
+        chunks = [self._chunk(name, k) for k in range(k0, k1 + 1)]
+        start = t0 - k0 * self.chunk_records
+        if len(chunks) == 1:
+            return chunks[0][start:start + t1 - t0]
+        return np.concatenate(chunks)[start:start + t1 - t0]
+
+    def create_variable(self, name, dimensions, data, dtype=float, **attributes):
+        """Queues a new variable; it is written by flush(). With data None it is only laid out."""
+        self._pending_variables.append((name, dimensions, data, dtype, attributes))
+
+    def set_attributes(self, **attributes):
+        """Queues global attributes; they are written by flush()."""
+        self._pending_attributes.update(attributes)
+
+    def flush(self):
+        if not self._pending_variables and not self._pending_attributes:
+            return
+        self.sync()
+        tmp_file = self.filename + ".tmp"
+        with profiling.timer("write back " + self.filename, "write"):
+            self._write_copy(tmp_file)
+        self._close_handle()
+        os.rename(tmp_file, self.filename)
+        self._pending_variables = []
+        self._pending_attributes = {}
+
+    def _write_copy(self, filename):
+        """Writes the file with the pending variables and attributes to filename."""
+        old = self.handle
+        fout = netcdf.netcdf_file(filename, "w")
+        # The record (unlimited) dimension has to be created first
+        for dim in sorted(old.dimensions, key=lambda d: old.dimensions[d] is not None):
+            fout.createDimension(dim, old.dimensions[dim])
+        for attr, value in list(self.attributes.items()) + list(self._pending_attributes.items()):
+            setattr(fout, attr, value)
+        nrecs = max([len(var.data) for var in old.variables.values() if var.isrec] or [0])
+        for name, var in old.variables.items():
+            out = fout.createVariable(name, var.typecode(), var.dimensions)
+            for attr, value in var._attributes.items():
+                setattr(out, attr, value)
+            # A view of the mapped old file, already in the byte order of
+            # the file; scipy writes it record by record
+            out.__dict__["data"] = var.data
+        for name, dimensions, data, dtype, attributes in self._pending_variables:
+            var = fout.createVariable(name, dtype, dimensions)
+            for attr, value in attributes.items():
+                setattr(var, attr, value)
+            if data is None:
+                # Only laid out: one zero, broadcast to the shape of the
+                # variable, so scipy writes the zeros one record at a time
+                shape = ((nrecs,) + var.shape[1:]) if var.isrec else var.shape
+                var.__dict__["data"] = np.broadcast_to(np.zeros((), var.data.dtype), shape)
+            else:
+                var[:] = data
+                profiling.count("bytes_written", np.asarray(data).nbytes)
+        fout.close()
+
+    def writable(self, name):
+        """
+        Variable name, mapped read/write onto the file: whatever is assigned
+        to it goes to disk without the file being rewritten. Create all
+        variables first, the next flush() invalidates the mapping.
+        """
+        self.flush()
+        with self._lock:
+            for key in [key for key in self._cache if key[0] == name]:
+                self._cached_bytes -= self._cache.pop(key).nbytes
+        data = self.handle.variables[name].data
+        # With mmap=True scipy hands out views of one read only mapping of
+        # the whole file; the bytes of the variable are mapped again,
+        # writable, at the same offset and with the same layout
+        mapping = data
+        while isinstance(mapping.base, np.ndarray):
+            mapping = mapping.base
+        if mapping.nbytes != os.path.getsize(self.filename):
+            raise RuntimeError("%s is not mapped as a whole, cannot map %s writable"
+                               % (self.filename, name))
+        offset = data.__array_interface__["data"][0] - mapping.__array_interface__["data"][0]
+        mapped = np.memmap(self.filename, np.uint8, "r+")
+        self._mapped.append(mapped)
+        return np.ndarray(data.shape, data.dtype, buffer=mapped, offset=offset,
+                          strides=data.strides)
+
+    def sync(self):
+        """Writes the chunks assigned to writable() variables to disk."""
+        for mapped in self._mapped:
+            mapped.flush()
+
+    def _close_handle(self):
+        self.sync()
+        self._mapped = []
+        self._cache.clear()
+        self._cached_bytes = 0
+        self._variables = {}
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def close(self):
+        self.flush()
+        self._close_handle()
+        if self._open_files.get(os.path.abspath(self.filename)) is self:
+            del self._open_files[os.path.abspath(self.filename)]
+
+    @classmethod
+    def close_all(cls):
+        for f in list(cls._open_files.values()):
+            f.close()
+
+
+class pism_variable(object):
+    """
+    One variable of a pism_output_file. Indexing it reads only the chunks
+    holding the requested records; the attributes (units, ...) are those of
+    the netCDF variable.
+    """
+    def __init__(self, dataset, name):
+        var = dataset.handle.variables[name]
+        self.dataset = dataset
+        self.name = name
+        self.dimensions = var.dimensions
+        self.shape = var.shape
+        self.dtype = var.data.dtype
+        self.is_record = bool(var.dimensions) and dataset.handle.dimensions[var.dimensions[0]] is None
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.dataset.handle.variables[self.name], name)
+
+    @property
+    def attributes(self):
+        return self.dataset.handle.variables[self.name]._attributes
+
+    def typecode(self):
+        return self.dataset.handle.variables[self.name].typecode()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        first, rest = index[0], index[1:]
+        if not self.shape or not isinstance(first, (slice, int, np.integer)):
+            return self.read()[index]
+        n = self.shape[0]
+        if isinstance(first, slice):
+            records = range(*first.indices(n))
+            if not len(records):
+                return np.empty((0,) + self.shape[1:], self.dtype)[(slice(None),) + rest]
+            t0, t1 = min(records), max(records) + 1
+            block = self.dataset.read_records(self.name, t0, t1)
+            if first.step not in (None, 1):
+                block = block[[t - t0 for t in records]]
+            return block[(slice(None),) + rest]
+        t = int(first) + n if first < 0 else int(first)
+        if not 0 <= t < n:
+            raise IndexError("Index %s out of range for %s with %d records" % (first, self.name, n))
+        return self.dataset.read_records(self.name, t, t + 1)[0][rest]
+
+    def chunks(self):
+        """Yields (t0, t1, records) for all chunks of a record variable, in order."""
+        step = self.dataset.chunk_records if self.is_record else len(self)
+        for t0 in range(0, len(self), step):
+            t1 = min(t0 + step, len(self))
+            yield t0, t1, self.dataset.read_records(self.name, t0, t1)
+
+    def read(self):
+        """The whole variable as one array."""
+        if not self.shape:
+            return np.array(self.dataset.handle.variables[self.name].data)
+        return self[:]
+
+
+class forcing_service(object):
+    """
+    Prepares "given" atmosphere forcing for coupled runs without paying the
+    start-up costs every coupling step: the remapping operator (one per GCM
+    grid, also kept on disk in the workdir), the x/y coordinates of the
+    PISM grid and the downscaling orography and mask are set up once and
+    reused for every request. With sparse_remap.py and a griddes file the
+    GCM file is remapped in-process, otherwise by cdo with cached weights.
+    """
+    def __init__(self, args):
+        self.CDO = cdo.Cdo() if cdo_available else None
+        self.griddes = args.ifile_griddes
+        self.method = args.remap_method
+        self.workdir = os.path.abspath(args.workdir)
+        if not os.path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+        self.weights = {}
+        self.operators = {}
+        self.grid = None
+        if sparse_remap_available and os.path.isfile(self.griddes):
+            self.grid = read_grid(self.griddes)
+        self.pism_coords = self._extract_pism_coords(args.pism_ifile)
+        self.downscale_statics = None
+        self.downscale_source = None
+        if args.downscale_hires and args.downscale_lores and args.downscale_mask:
+            sources = (args.downscale_hires, args.downscale_lores, args.downscale_mask)
+            elev_hi, elev_lo, mask = [pism_output_file.open(f)[v].read().squeeze()
+                                      for f, v in sources]
+            with profiling.timer("downscale_statics", "compute"):
+                self.downscale_statics = downscale_statics(elev_hi, elev_lo, mask,
+                                                           args.downscale_half_a_box)
+            # What the statics were computed from, recorded in the journal
+            # of every request so a resumed file never mixes two of them
+            self.downscale_source = {
+                "fields": [[os.path.abspath(f), v, checkpoint.file_fingerprint(f)]
+                           for f, v in sources],
+                "half_a_box": args.downscale_half_a_box}
+
+    def _extract_pism_coords(self, pism_ifile):
+        coords = os.path.join(self.workdir, "pism_coords.nc")
+        tmp = os.path.join(self.workdir, "pism_coords_tmp.nc")
+        NCO = nco.Nco()
+        NCO.ncks(options="-c", input=pism_ifile, output=tmp)
+        # Same renaming as in given_atmo
+        os.system("ncrename -O -o "+coords+" -d .x1,x -d .y1,y -v .x1,x -v .y1,y "+tmp)
+        os.remove(tmp)
+        return coords
+
+    def _grid_key(self, fin):
+        key = hashlib.md5()
+        key.update((self.griddes + self.method).encode())
+        if "lon" in fin and "lat" in fin:
+            key.update(fin["lon"].read().tobytes())
+            key.update(fin["lat"].read().tobytes())
+        else:
+            key.update("\n".join(self.CDO.griddes(input=fin.filename)).encode())
+        return key.hexdigest()
+
+    def _operator_for(self, fin):
+        key = self._grid_key(fin)
+        if key not in self.operators:
+            weights = os.path.join(self.workdir, "weights_%s_%s.npz" % (self.method, key))
+            method = {"con": "conservative", "bil": "bilinear"}[self.method]
+            self.operators[key] = _remap_operator_for(
+                argparse.Namespace(weights=weights, ifile_griddes=self.griddes),
+                method, fin["lon"].read(), fin["lat"].read(), self.grid)
+        else:
+            profiling.count("cache_hits")
+        return self.operators[key]
+
+    def _weights_for(self, fin):
+        key = self._grid_key(fin)
+        if key not in self.weights:
+            weights = os.path.join(self.workdir, "weights_%s_%s.nc" % (self.method, key))
+            if not os.path.exists(weights):
+                logging.info("Generating %s weights for %s" % (self.method, fin.filename))
+                with profiling.timer("cdo gen" + self.method, "compute"):
+                    getattr(self.CDO, "gen" + self.method)(self.griddes, input=fin.filename,
+                                                           output=weights)
+            else:
+                profiling.count("cache_hits")
+            self.weights[key] = weights
+        else:
+            profiling.count("cache_hits")
+        return self.weights[key]
+
+    def prepare(self, request):
+        """
+        Remaps request["gcm_file"] with the cached operator (or weights) and
+        writes the PISM "given" atmosphere file to request["ofile"], which is
+        returned.
+        """
+        fin = pism_output_file.open(request["gcm_file"])
+        remapped = os.path.join(self.workdir, "remapped.nc")
+        try:
+            if self.grid is not None and "lon" in fin and "lat" in fin:
+                _sparse_remap_file(fin, remapped, self._operator_for(fin), self.grid)
+            elif self.CDO is not None:
+                weights = self._weights_for(fin)
+                with profiling.timer("cdo remap", "compute"):
+                    self.CDO.remap(self.griddes + "," + weights, input=fin.filename,
+                                   output=remapped, options="-f nc")
+            else:
+                raise ValueError("%s has no lon/lat and cdo is not available to remap it"
+                                 % fin.filename)
+        finally:
+            # The GCM writes the next request to the same file name
+            fin.close()
+        try:
+            given_atmo(argparse.Namespace(ifile_temperature=remapped,
+                                          ifile_precipitation=remapped,
+                                          ofile=request["ofile"],
+                                          pism_ifile=None,
+                                          pism_coords=self.pism_coords,
+                                          tempvarname=request.get("tempvarname", "temp2"),
+                                          precipvarname=request.get("precipvarname", "aprs"),
+                                          downscale_statics=self.downscale_statics,
+                                          downscale_source=self.downscale_source))
+        finally:
+            # A handle left open by a failed request would keep mapping the
+            # old remapped.nc and hand its data to the next request; only
+            # pism_coords stays resident
+            for filename in (remapped, checkpoint.part_name(request["ofile"])):
+                pism_output_file.open(filename).close()
+            if os.path.exists(remapped):
+                os.remove(remapped)
+        return request["ofile"]
+
+
+class _forcing_request_handler(socketserver.StreamRequestHandler):
+    # One JSON object per line in, one JSON object per line out
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode())
+        if request.get("command") == "shutdown":
+            self.server.done = True
+            reply = {"status": "ok"}
+        else:
+            now = time.time()
+            try:
+                reply = {"status": "ok",
+                         "ofile": self.server.service.prepare(request),
+                         "seconds": time.time() - now}
+                logging.info("Prepared %s in %.1f s" % (reply["ofile"], reply["seconds"]))
+            except Exception as e:
+                logging.error("Request %s failed: %s" % (request, e))
+                reply = {"status": "error", "message": str(e)}
+        self.wfile.write((json.dumps(reply) + "\n").encode())
 
 
 ############
 # FUNCTIONS
 ############
+
+# Time chunks that may wait between the read, compute and write stages of
+# a pipeline, and the memory all chunks in flight may take up together
+PIPELINE_DEPTH = 2
+PIPELINE_BYTES = 512 * 2**20
+
+
 def remap(args):
+    if getattr(args, "engine", "cdo") == "sparse":
+        return sparse_remap(args, "conservative")
+    if not cdo_available:
+        logging.error("cdo-python interface not found, use --engine sparse")
+        sys.exit(1)
     CDO = cdo.Cdo()
     if not os.path.exists(args.ofile):
-        CDO.remapcon(args.ifile_griddes, input=args.ifile_gcm,
-                     output=args.ofile, options="-f nc -v")
+        part = checkpoint.part_name(args.ofile)
+        with profiling.timer("cdo remapcon", "compute"):
+            CDO.remapcon(args.ifile_griddes, input=args.ifile_gcm,
+                         output=part, options="-f nc -v")
+        os.rename(part, args.ofile)
         logging.info("Outfile generated here: %s" % (args.ofile))
     else:
         logging.info("Outfile exists here: %s" % (args.ofile))
 
 
 def interpolate(args):
+    if getattr(args, "engine", "cdo") == "sparse":
+        return sparse_remap(args, "bilinear")
+    if not cdo_available:
+        logging.error("cdo-python interface not found, use --engine sparse")
+        sys.exit(1)
     CDO = cdo.Cdo()
     if not os.path.exists(args.ofile):
-        CDO.remapbil(args.ifile_griddes, input=args.ifile_gcm,
-                     output=args.ofile, options="-f nc -v")
+        part = checkpoint.part_name(args.ofile)
+        with profiling.timer("cdo remapbil", "compute"):
+            CDO.remapbil(args.ifile_griddes, input=args.ifile_gcm,
+                         output=part, options="-f nc -v")
+        os.rename(part, args.ofile)
         logging.info("Outfile generated here: %s" % (args.ofile))
     else:
         logging.info("Outfile exists here: %s" % (args.ofile))
 
 
+def _remap_operator_for(args, method, src_lon, src_lat, grid):
+    """Loads the operator from args.weights if it fits, otherwise builds (and saves) it."""
+    weights = getattr(args, "weights", None)
+    operator = None
+    if weights and os.path.exists(weights):
+        with profiling.timer("read weights", "read"):
+            try:
+                if weights.endswith(".npz"):
+                    operator = remap_operator.load(weights)
+                else:
+                    operator = remap_operator.from_scrip(weights)
+            except KeyError:
+                logging.warning("%s has no grid shapes (older format), recomputing" % weights)
+        if operator is not None and not operator.fits((len(src_lat), len(src_lon)), grid):
+            logging.warning("Weights in %s do not fit the GCM grid and %s, recomputing"
+                            % (weights, args.ifile_griddes))
+            operator = None
+        elif operator is not None:
+            profiling.count("cache_hits")
+    if operator is None:
+        with profiling.timer("compute %s weights" % method, "compute"):
+            if method == "conservative":
+                if "xbounds" not in grid:
+                    logging.error("%s has no xbounds/ybounds, needed for conservative remapping" % args.ifile_griddes)
+                    sys.exit(1)
+                operator = remap_operator.conservative(src_lon, src_lat, grid["xbounds"], grid["ybounds"])
+            else:
+                operator = remap_operator.bilinear(src_lon, src_lat, grid["xvals"], grid["yvals"])
+        operator.dst_hash = grid_hash(grid)
+        if weights and weights.endswith(".npz"):
+            operator.save(weights)
+            logging.info("Weights saved to %s" % weights)
+    return operator
+
+
+def _write_grid_coordinates(fout, grid, dst_dims):
+    """lon/lat (and their bounds) of the destination grid, named as cdo names them."""
+    for name, values, bounds, axis in (("lon", "xvals", "xbounds", "Lon"),
+                                       ("lat", "yvals", "ybounds", "Lat")):
+        var = fout.createVariable(name, "d", dst_dims)
+        var.standard_name = {"lon": "longitude", "lat": "latitude"}[name]
+        var.long_name = var.standard_name
+        var.units = {"lon": "degrees_east", "lat": "degrees_north"}[name]
+        var._CoordinateAxisType = axis
+        var[:] = grid[values]
+        if bounds in grid:
+            nv = grid[bounds].shape[-1]
+            if "nv%d" % nv not in fout.dimensions:
+                fout.createDimension("nv%d" % nv, nv)
+            var.bounds = name + "_bnds"
+            bnds = fout.createVariable(name + "_bnds", "d", dst_dims + ("nv%d" % nv,))
+            bnds[:] = grid[bounds]
+
+
+def sparse_remap(args, method):
+    """
+    Same job as remap/interpolate, but in-process: every variable on the
+    (lat, lon) grid of the GCM file, with all its time records, is remapped
+    by one sparse matrix product. The destination lon/lat come from the
+    grid description, as with cdo.
+    """
+    if not sparse_remap_available:
+        logging.error("sparse_remap.py not found, use --engine cdo")
+        sys.exit(1)
+    if os.path.exists(args.ofile):
+        logging.info("Outfile exists here: %s" % (args.ofile))
+        return
+    fin = pism_output_file.open(args.ifile_gcm)
+    src_lon = fin["lon"].read()
+    src_lat = fin["lat"].read()
+    grid = read_grid(args.ifile_griddes)
+    operator = _remap_operator_for(args, method, src_lon, src_lat, grid)
+    _sparse_remap_file(fin, args.ofile, operator, grid)
+    fin.close()
+    logging.info("Outfile generated here: %s" % (args.ofile))
+
+
+def _sparse_remap_file(fin, ofile, operator, grid):
+    """Remaps the open GCM file fin with operator onto grid, written to ofile."""
+    src_lon = fin["lon"].read()
+    src_lat = fin["lat"].read()
+    varnames = [name for name, var in fin.variables.items()
+                if var.dimensions[-2:] == ("lat", "lon")]
+    part = checkpoint.part_name(ofile)
+    fout = netcdf.netcdf_file(part, "w")
+    # The record (unlimited) dimension has to be created first
+    for dim in sorted(fin.dimensions, key=lambda d: fin.dimensions[d] is not None):
+        if dim not in ("lat", "lon"):
+            fout.createDimension(dim, fin.dimensions[dim])
+    dst_dims = ("y", "x") if len(operator.dst_shape) == 2 else ("ncells",)
+    for dim, size in zip(dst_dims, operator.dst_shape):
+        fout.createDimension(dim, size)
+    _write_grid_coordinates(fout, grid, dst_dims)
+    # Everything that is not on the horizontal grid is copied as is; the
+    # source coordinates and their bounds are replaced by the destination ones
+    for name, var in fin.variables.items():
+        if name in varnames or name in fout.variables:
+            continue
+        if "lat" in var.dimensions or "lon" in var.dimensions:
+            # e.g. lat_bnds, replaced by the bounds from the grid description
+            logging.info("%s %s is not on the (lat, lon) grid, left out" % (name, var.dimensions))
+            continue
+        out = fout.createVariable(name, var.typecode(), var.dimensions)
+        for attr, value in var.attributes.items():
+            setattr(out, attr, value)
+        if var.shape:
+            out[:] = var.read()
+        else:
+            # Scalars, which out[:] cannot index
+            out.data[...] = var.read()
+    # All records of all variables as rows of one (n, nlat*nlon) array
+    fields = [fin[name].read().reshape(-1, src_lon.size * src_lat.size)
+              for name in varnames]
+    stacked = np.concatenate(fields)
+    with profiling.timer("remap", "compute"):
+        remapped = operator.apply(stacked.reshape((-1,) + operator.src_shape))
+    start = 0
+    for name, field in zip(varnames, fields):
+        var = fin[name]
+        out = fout.createVariable(name, var.typecode(), var.dimensions[:-2] + dst_dims)
+        for attr, value in var.attributes.items():
+            setattr(out, attr, value)
+        out.coordinates = "lon lat"
+        with profiling.timer("write " + name, "write"):
+            out[:] = remapped[start:start + field.shape[0]].reshape(var.shape[:-2] + operator.dst_shape)
+        start += field.shape[0]
+    profiling.count("bytes_written", remapped.nbytes)
+    for attr, value in fin.attributes.items():
+        setattr(fout, attr, value)
+    fout.close()
+    os.rename(part, ofile)
+
+
 def given_atmo(args):
-    fin_temp = netcdf.netcdf_file(args.ifile_temperature)
-    if fin_temp.source == "ECHAM5.4":
+    fin_temp = pism_output_file.open(args.ifile_temperature)
+    if getattr(args, "tempvarname", None):
+        tempvarname = args.tempvarname
+    elif fin_temp.source == "ECHAM5.4":
         tempvarname = "temp2"
     elif fin_temp.source == "ECHAM6":
         tempvarname = "temp2"
     else:
         logging.warn("Model unknown, waiting for user response...")
-        print fin_temp.variables
+        print sorted(fin_temp.variables)
         tempvarname = input("What is the temperature varname you want to use? ")
-    fin_precip = netcdf.netcdf_file(args.ifile_precipitation)
-    if fin_precip.source == "ECHAM5.4":
+    fin_precip = pism_output_file.open(args.ifile_precipitation)
+    if getattr(args, "precipvarname", None):
+        precipvarname = args.precipvarname
+    elif fin_precip.source == "ECHAM5.4":
         precipvarname = "aprs"
     elif fin_precip.source == "ECHAM6":
         precipvarname = "aprs"
     else:
         logging.warn("Model unknown, waiting for user response...")
-        print fin_precip.variables
+        print sorted(fin_precip.variables)
         precipvarname = input("What is the precip varname you want to use? ")
-    shutil.copy(fin_temp.filename, args.ofile)
-    fout = netcdf.netcdf_file(args.ofile, "a")
-    ############################################################
-    # Write Air Temperature
-    ############################################################
-    air_temp = fout.createVariable("air_temp", float, ("time", 'y', 'x'))
-    air_temp.standard_name = "air_temperature"
-    air_temp.units = "K"
-    air_temp.long_name = "Air Temperature (2 meter)"
-    air_temp.grid_mapping = "mapping"
-    air_temp.coordinates = "lon lat"
-    air_temp[:] = fin_temp.variables[tempvarname].data
-    ############################################################
-    # Write Precipitation
-    ############################################################
-    precip = fout.createVariable("precipitation", float, ("time", 'y', 'x'))
-    precip.units = "m s-1"
-    precip.long_name = "Yearly mean total precipitation"
-    precip.standard_name = "lwe_precipitation_rate"
-    precip._FillValue = "-9.e+33f"
-    p = fin_precip.variables[precipvarname].data
-    p = p/910.
-    precip[:] = p
-    ############################################################
-    # Write output
-    ############################################################
-    fout.author = "Paul J. Gierz"
-    fout.institution = "Alfred Wegener Institute"
-    fout.history = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")+" Modified with script:\n pism_input_from_gcm.py prep_file_atmo "+fin_temp.filename+" "+fin_precip.filename+"\n"+fout.history
-    fout.sync()
+    journal = checkpoint.chunk_journal(
+        args.ofile, [fin_temp.filename, fin_precip.filename],
+        {"tempvarname": tempvarname, "precipvarname": precipvarname,
+         "downscaled": getattr(args, "downscale_source", None)})
+    resumed = journal.resume()
+    if not resumed:
+        shutil.copy(fin_temp.filename, journal.part)
+    fout = pism_output_file.open(journal.part)
+    try:
+        temp = fin_temp[tempvarname]
+        precip = fin_precip[precipvarname]
+        if not resumed:
+            ############################################################
+            # Write Air Temperature
+            ############################################################
+            fout.create_variable("air_temp", ("time", 'y', 'x'), None,
+                                 standard_name="air_temperature",
+                                 units="K",
+                                 long_name="Air Temperature (2 meter)",
+                                 grid_mapping="mapping",
+                                 coordinates="lon lat")
+            ############################################################
+            # Write Precipitation
+            ############################################################
+            fout.create_variable("precipitation", ("time", 'y', 'x'), None,
+                                 units="m s-1",
+                                 long_name="Yearly mean total precipitation",
+                                 standard_name="lwe_precipitation_rate",
+                                 _FillValue="-9.e+33f")
+            ############################################################
+            # Write output
+            ############################################################
+            if getattr(args, "pism_coords", None):
+                # x/y of the PISM grid, extracted once by the forcing service
+                # and kept open there
+                coords = pism_output_file.open(args.pism_coords)
+                for name, var in coords.variables.items():
+                    if name not in fout and set(var.dimensions) <= set(fout.dimensions):
+                        fout.create_variable(name, var.dimensions, var.read(), var.typecode(),
+                                             **var.attributes)
+            fout.set_attributes(author="Paul J. Gierz",
+                                institution="Alfred Wegener Institute",
+                                history=datetime.datetime.now().strftime("%Y-%m-%d %H:%M")+" Modified with script:\n pism_input_from_gcm.py prep_file_atmo "+fin_temp.filename+" "+fin_precip.filename+"\n"+fout.history)
+            fout.flush()
+            journal.start()
+        # Both variables are laid out in the file in one go and then filled
+        # chunk by chunk, reading the next and writing the last chunk meanwhile
+        air_temp = fout.writable("air_temp")
+        precipitation = fout.writable("precipitation")
+
+        def read(key):
+            t0, t1 = key
+            return temp[t0:t1], precip[t0:t1]
+
+        def convert(key, data):
+            t, p = data
+            if getattr(args, "downscale_statics", None) is not None:
+                # Set by the forcing service, which keeps the orography and mask in memory
+                t = _downscale_with_statics(t, args.downscale_statics)
+            return t, p/910.
+
+        def write(key, data):
+            t0, t1 = key
+            air_temp[t0:t1], precipitation[t0:t1] = data
+            fout.sync()
+            journal.mark("given_atmo", key)
+        pipeline.chunk_pipeline(read, convert, write, PIPELINE_DEPTH, PIPELINE_BYTES).run(
+            journal.pending("given_atmo", pipeline.time_chunks(len(temp), fin_temp.chunk_records)))
+    finally:
+        # The forcing service reuses the same file names for every request,
+        # so not even a failed one may leave its handles open
+        fout.close()
+        fin_temp.close()
+        fin_precip.close()
     ############################################################
     # Make X and Y
     ############################################################
+    if getattr(args, "pism_coords", None):
+        # Already copied from the PISM input file (forcing service)
+        journal.publish()
+        return None
     # logging.warn("Trying to do NCO by python-nco interface...")
     NCO = nco.Nco()
     NCO.ncks(options="-c", input=args.pism_ifile, output="foo.nc")
@@ -315,68 +1079,81 @@ def given_atmo(args):
     os.system("rm foo.nc foo1.nc")
     # logging.warn("The warning just produced by ncks at this point does not cause any problems")
     ############################################################
+    journal.publish()
     return None
 
 
 def yearly_cycle_atmo(args):
-    fin_temp = netcdf.netcdf_file(args.ifile_temperature)
+    fin_temp = pism_output_file.open(args.ifile_temperature)
     if fin_temp.source == "ECHAM5.4":
         tempvarname = "temp2"
     elif fin_temp.source == "ECHAM6":
         tempvarname = "temp2"
     else:
         logging.warn("Model unknown, waiting for user response...")
-        print fin_temp.variables
+        print sorted(fin_temp.variables)
         tempvarname = input("What is the temperature varname you want to use? ")
-    fin_precip = netcdf.netcdf_file(args.ifile_precipitation)
+    fin_precip = pism_output_file.open(args.ifile_precipitation)
     if fin_precip.source == "ECHAM5.4":
         precipvarname = "precip"
     elif fin_precip.source == "ECHAM6":
         precipvarname = "precip"
     else:
         logging.warn("Model unknown, waiting for user response...")
-        print fin_precip.variables
+        print sorted(fin_precip.variables)
         precipvarname = input("What is the precip varname you want to use? ")
     shutil.copy(fin_temp.filename, args.ofile)
-    fout = netcdf.netcdf_file(args.ofile, "a")
+    fout = pism_output_file.open(args.ofile)
+    ############################################################
+    # Annual sums
+    ############################################################
+    # The means are summed up chunk by chunk while the next chunk is read,
+    # the full cycle is never in memory
+    temp = fin_temp[tempvarname]
+    precip = fin_precip[precipvarname]
+
+    def read(key):
+        t0, t1 = key
+        return temp[t0:t1], precip[t0:t1]
+
+    def annual_sums(key, data):
+        return [field.sum(axis=0, dtype=np.float64) for field in data]
+    sums = pipeline.chunk_pipeline(read, annual_sums, None, PIPELINE_DEPTH, PIPELINE_BYTES).run(
+        pipeline.time_chunks(len(temp), fin_temp.chunk_records))
+    t_sum = sum(s[0] for key, s in sums)
+    p_sum = sum(s[1] for key, s in sums)
     ############################################################
     # Make Annual Surface Temp
     ############################################################
-    air_temp_mean_annual = fout.createVariable("air_temp_mean_annual", float,
-                                               ('y', 'x'))
-    air_temp_mean_annual.standard_name = "air_temperature"
-    air_temp_mean_annual.units = "K"
-    air_temp_mean_annual.long_name = "Annual Mean Air Temperature (2 meter)"
-    air_temp_mean_annual.grid_mapping = "mapping"
-    air_temp_mean_annual.coordinates = "lon lat"
-    air_temp_mean_annual._FillValue = "-9.e+33f"
-    air_temp_mean_annual[:] = fin_temp.variables[tempvarname].data.mean(axis=0)
+    fout.create_variable("air_temp_mean_annual", ('y', 'x'), t_sum / len(temp),
+                         standard_name="air_temperature",
+                         units="K",
+                         long_name="Annual Mean Air Temperature (2 meter)",
+                         grid_mapping="mapping",
+                         coordinates="lon lat",
+                         _FillValue="-9.e+33f")
 
     ############################################################
     # July Mean Surface Temp
     ############################################################
-    air_temp_mean_july = fout.createVariable("air_temp_mean_july", float,
-                                             ('y', 'x'))
-    air_temp_mean_july.standard_name = "air_temperature"
-    air_temp_mean_july.units = "K"
-    air_temp_mean_july.long_name = "July Mean Air Temperature (2 meter)"
-    air_temp_mean_july.grid_mapping = "mapping"
-    air_temp_mean_july.coordinates = "lon lat"
-    air_temp_mean_july._FillValue = "-9.e+33f"
-    air_temp_mean_july[:] = fin_temp.variables[tempvarname].data[6, :, :]
+    # Comes from the chunk cache
+    fout.create_variable("air_temp_mean_july", ('y', 'x'), temp[6, :, :],
+                         standard_name="air_temperature",
+                         units="K",
+                         long_name="July Mean Air Temperature (2 meter)",
+                         grid_mapping="mapping",
+                         coordinates="lon lat",
+                         _FillValue="-9.e+33f")
     ############################################################
     # Precipitation
     ############################################################
-    precipitation = fout.createVariable("precipitation", float,
-                                        ('y', 'x'))
-    precipitation.units = "m s-1"
-    precipitation.long_name = "Yearly mean total precipitation"
-    precipitation.standard_name = "lwe_precipitation_rate"
-    precipitation._FillValue = "-9.e+33f"
-    p = fin_precip.variables[precipvarname].data.mean(axis=0)
     # PG: This is yearly average, maybe better to use a full cycle
-    p = p/910.  # PG: Convert from kg/m^2s => m/s ice equivalent, see NOTE
-    precipitation[:] = p
+    p = p_sum / len(precip) / 910.  # PG: Convert from kg/m^2s => m/s ice equivalent, see NOTE
+    fout.create_variable("precipitation", ('y', 'x'), p,
+                         units="m s-1",
+                         long_name="Yearly mean total precipitation",
+                         standard_name="lwe_precipitation_rate",
+                         _FillValue="-9.e+33f")
     ############################################################
     # NOTE: Someone needs to confirm this
     # p [kg/m^-2 * s] = [1 l/s] = [1 mm/s] * rho_liquid / rho_solid * 1 [m] / 1000 [mm] = p [m_ice/s]
@@ -387,10 +1164,12 @@ def yearly_cycle_atmo(args):
     # will be written to it.
     #
     ############################################################
-    fout.author = "Paul J. Gierz"
-    fout.institution = "Alfred Wegener Institute"
-    fout.history = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")+" Modified with script:\n pism_input_from_gcm.py prep_file_atmo "+fin_temp.filename+" "+fin_precip.filename+"\n"+fout.history
-    fout.sync()
+    fout.set_attributes(author="Paul J. Gierz",
+                        institution="Alfred Wegener Institute",
+                        history=datetime.datetime.now().strftime("%Y-%m-%d %H:%M")+" Modified with script:\n pism_input_from_gcm.py prep_file_atmo "+fin_temp.filename+" "+fin_precip.filename+"\n"+fout.history)
+    fout.close()
+    fin_temp.close()
+    fin_precip.close()
     ############################################################
     # Make X and Y
     ############################################################
@@ -414,26 +1193,305 @@ def yearly_cycle_atmo(args):
     return None
 
 
-def downscale(args):
-    if downscale_available:
-        field_hi = downscale_field(
-            netcdf.netcdf_file(args.downscale_gcm[0]).variables[args.downscale_gcm[1]].data.squeeze(),
-            netcdf.netcdf_file(args.downscale_hires[0]).variables[args.downscale_hires[1]].data.squeeze(),
-            netcdf.netcdf_file(args.downscale_lores[0]).variables[args.downscale_lores[1]].data.squeeze(),
-            netcdf.netcdf_file(args.downscale_mask[0]).variables[args.downscale_mask[1]].data.squeeze(),
-            half_a_box=args.downscale_half_a_box)
-        shutil.copy(args.downscale_gcm[0], args.ofile)
-        fout = netcdf.netcdf_file(args.ofile, "a")
-        if netcdf.netcdf_file(args.downscale_gcm[0]).variables[args.downscale_gcm[1]].data.squeeze().shape == 2:
-            downscaled_temp = fout.createVariable("air_temp_downscaled", float,
-                                                  ("y", "x"))
+def _downscale_with_statics(field, statics):
+    field_hi = downscale_field(field.squeeze(), None, None, None, statics=statics,
+                               dtype=field.dtype)
+    # Cells the kernel does not touch (outside the mask, at the borders)
+    # keep the remapped value
+    np.copyto(field_hi, field.squeeze(), where=np.isnan(field_hi))
+    return field_hi.reshape(field.shape)
+
+
+def _conservative_aggregation_weights(pism_lat, pism_lon, cell_area, gcm_lat, gcm_lon):
+    """
+    Builds the overlap operator from the fine PISM grid to the coarse GCM
+    grid as a scipy.sparse CSR matrix of shape (n_gcm, n_pism). Entry
+    (g, p) is the area of PISM cell p lying in GCM cell g.
+
+    The PISM cells are much smaller than the GCM cells, so every PISM cell
+    is given entirely to the GCM cell containing its center. Summed over a
+    GCM cell this conserves area (and anything multiplied by it) exactly.
+    """
+    import scipy.sparse
+    # ECHAM latitudes run from north to south
+    lat_order = np.argsort(gcm_lat)
+    lat_edges = cell_edges(np.asarray(gcm_lat)[lat_order], -90., 90.)
+    lon_edges = cell_edges(gcm_lon, 0., 0.)
+    lon_edges[0] = gcm_lon[0] - 0.5 * (gcm_lon[1] - gcm_lon[0])
+    lon_edges[-1] = lon_edges[0] + 360.
+    ilat = lat_order[np.clip(np.searchsorted(lat_edges, pism_lat.ravel()) - 1,
+                             0, len(gcm_lat) - 1)]
+    ilon = np.clip(np.searchsorted(lon_edges, (pism_lon.ravel() - lon_edges[0]) % 360. + lon_edges[0]) - 1,
+                   0, len(gcm_lon) - 1)
+    rows = ilat * len(gcm_lon) + ilon
+    cols = np.arange(pism_lat.size)
+    areas = np.broadcast_to(cell_area, pism_lat.shape).ravel()
+    return scipy.sparse.csr_matrix((areas, (rows, cols)),
+                                   shape=(len(gcm_lat) * len(gcm_lon), pism_lat.size))
+
+
+def _pism_cell_area(files, x, y, pism_lat):
+    """
+    Area on the sphere of the PISM grid cells: PISM's cell_area if one of
+    files has it, otherwise from the polar stereographic projection (see
+    projected_cell_area).
+    """
+    for f in files:
+        if "cell_area" in f:
+            area = f["cell_area"].read()
+            return area.reshape((-1,) + area.shape[-2:])[-1]
+    for f in files:
+        if "mapping" in f:
+            return projected_cell_area(x, y, pism_lat, f["mapping"].attributes)
+    return projected_cell_area(x, y, pism_lat)
+
+
+def _gcm_cell_area(gcm_lat, gcm_lon, radius=6371000.):
+    """Spherical area of the GCM grid cells, shape (nlat, nlon)."""
+    lat_order = np.argsort(gcm_lat)
+    lat_edges = np.radians(cell_edges(np.asarray(gcm_lat)[lat_order], -90., 90.))
+    band = np.empty(len(gcm_lat))
+    band[lat_order] = np.diff(np.sin(lat_edges))
+    return radius ** 2 * np.radians(360. / len(gcm_lon)) * np.outer(band, np.ones(len(gcm_lon)))
+
+
+def export_to_gcm(args):
+    import scipy.sparse
+    if not sparse_remap_available:
+        logging.error("sparse_remap.py not found, needed for export_to_gcm")
+        sys.exit(1)
+    fin = pism_output_file.open(args.ifile_pism)
+    fgrid = pism_output_file.open(args.ifile_pism_grid) if args.ifile_pism_grid else fin
+    ftemplate = pism_output_file.open(args.ifile_gcm_template)
+    gcm_lat = ftemplate["lat"].read()
+    gcm_lon = ftemplate["lon"].read()
+    nlat, nlon = len(gcm_lat), len(gcm_lon)
+    x = fin["x"].read()
+    y = fin["y"].read()
+    npism = len(x) * len(y)
+    pism_lat = fgrid["lat"].read().squeeze()
+    cell_area = _pism_cell_area([fgrid, fin], x, y, pism_lat)
+    total_area = float(np.sum(np.broadcast_to(cell_area, pism_lat.shape)))
+    ############################################################
+    # Overlap operator, computed once per pair of grids
+    ############################################################
+    W = None
+    if args.weights and os.path.exists(args.weights):
+        with profiling.timer("read weights", "read"):
+            W = scipy.sparse.load_npz(args.weights).tocsr()
+        # The weights sum to the area of the PISM domain
+        if W.shape != (nlat * nlon, npism) or not np.isclose(W.sum(), total_area, rtol=1e-6):
+            logging.warning("Weights in %s do not fit these grids, recomputing" % args.weights)
+            W = None
         else:
-            downscaled_temp = fout.createVariable("air_temp_downscaled", float,
-                                                  ("time", "y", "x"))
+            profiling.count("cache_hits")
+    if W is None:
+        with profiling.timer("compute weights", "compute"):
+            W = _conservative_aggregation_weights(pism_lat, fgrid["lon"].read().squeeze(),
+                                                  cell_area, gcm_lat, gcm_lon)
+        if args.weights:
+            scipy.sparse.save_npz(args.weights, W)
+            logging.info("Weights saved to %s" % args.weights)
+    gcm_area = _gcm_cell_area(gcm_lat, gcm_lon).ravel()
+    covered_area = np.asarray(W.sum(axis=1)).ravel()
+    covered = covered_area > 0
+    ############################################################
+    # All variables and time records in one sparse product
+    ############################################################
+    varnames = args.variables.split(",")
+    if "mask" in varnames:
+        # Area means of the integer mask codes mean nothing
+        logging.warning("mask is aggregated as ice_fraction, not area-averaged")
+        varnames.remove("mask")
+    ntime = len(fin["mask"])
+    # Filled chunk by chunk, so no second full copy of any variable is made
+    stacked = np.empty((len(varnames) + 1, ntime, npism))
+    for t0, t1, mask in fin["mask"].chunks():
+        mask = mask.reshape(t1 - t0, npism)
+        stacked[0, t0:t1] = (mask == 2) | (mask == 3)
+    for n, varname in enumerate(varnames):
+        for t0, t1, field in fin[varname].chunks():
+            stacked[n + 1, t0:t1] = field.reshape(t1 - t0, npism)
+    with profiling.timer("aggregate", "compute"):
+        # (n_gcm, n_pism) x (n_pism, nvars*ntime)
+        aggregated = W.dot(stacked.reshape(-1, npism).T).T.reshape(len(varnames) + 1, ntime, -1)
+        means = np.zeros_like(aggregated)
+        means[:, :, covered] = aggregated[:, :, covered] / covered_area[covered]
+    ############################################################
+    # Aggregated PISM fields on the GCM grid
+    ############################################################
+    with profiling.timer("write aggregated fields", "write"):
+        fout = netcdf.netcdf_file(args.ofile, "w")
+        fout.createDimension("time", None)
+        fout.createDimension("lat", nlat)
+        fout.createDimension("lon", nlon)
+        for name, values, units in (("lat", gcm_lat, "degrees_north"), ("lon", gcm_lon, "degrees_east")):
+            var = fout.createVariable(name, "d", (name,))
+            var.units = units
+            var[:] = values
+        time_var = fout.createVariable("time", "d", ("time",))
+        time_var.units = getattr(fin["time"], "units", "seconds since 1-1-1")
+        time_var[:] = fin["time"].read()
+        var = fout.createVariable("ice_fraction", "d", ("time", "lat", "lon"))
+        var.long_name = "Fraction of the grid cell covered by PISM ice"
+        var[:] = (aggregated[0] / gcm_area).reshape(ntime, nlat, nlon)
+        for n, varname in enumerate(varnames):
+            var = fout.createVariable(varname, "d", ("time", "lat", "lon"))
+            var.long_name = "Area mean of PISM " + varname + " over the part of the cell inside the PISM domain"
+            if hasattr(fin[varname], "units"):
+                var.units = fin[varname].units
+            var[:] = means[n + 1].reshape(ntime, nlat, nlon)
+        fout.history = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")+" Generated with script:\n pism_input_from_gcm.py export_to_gcm "+args.ifile_pism
+        fout.close()
+    logging.info("Aggregated fields written to %s" % args.ofile)
+    ############################################################
+    # ECHAM orography and glacier mask, last time record
+    ############################################################
+    # Inside the PISM domain the PISM values replace the GCM ones, weighted
+    # by the covered fraction of each cell
+    fraction = (covered_area / gcm_area).clip(0, 1)
+    with profiling.timer("write echam file", "write"):
+        shutil.copy(args.ifile_gcm_template, args.ofile_echam)
+        fecham = netcdf.netcdf_file(args.ofile_echam, "a")
+        oro = fecham.variables[args.oro_varname]
+        if "usurf" in varnames:
+            usurf = means[varnames.index("usurf") + 1, -1]
+            oro[:] = (fraction * usurf + (1 - fraction) * oro.data.ravel()).reshape(oro.shape)
+        else:
+            logging.warning("usurf not aggregated, %s left unchanged" % args.oro_varname)
+        glac = fecham.variables[args.glac_varname]
+        glac[:] = ((aggregated[0, -1] / gcm_area).clip(0, 1) +
+                   (1 - fraction) * glac.data.ravel()).reshape(glac.shape)
+        fecham.history = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")+" Modified with script:\n pism_input_from_gcm.py export_to_gcm "+args.ifile_pism+"\n"+getattr(fecham, "history", "")
+        fecham.close()
+    logging.info("ECHAM surface file written to %s" % args.ofile_echam)
+    pism_output_file.close_all()
+
+
+def serve(args):
+    if not cdo_available and not (sparse_remap_available and os.path.isfile(args.ifile_griddes)):
+        logging.error("The forcing service needs the cdo-python interface, or sparse_remap.py and a griddes file")
+        sys.exit(1)
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = socketserver.UnixStreamServer(args.socket, _forcing_request_handler)
+    server.service = forcing_service(args)
+    server.done = False
+    logging.info("Forcing service listening on %s" % args.socket)
+    try:
+        while not server.done:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+    logging.info("Forcing service stopped")
+
 
-        downscaled_temp[:] = field_hi
+def request_forcing(args):
+    if args.shutdown:
+        request = {"command": "shutdown"}
+    elif args.ifile_gcm and args.ofile_forcing:
+        request = {"gcm_file": os.path.abspath(args.ifile_gcm),
+                   "ofile": os.path.abspath(args.ofile_forcing),
+                   "tempvarname": args.tempvarname,
+                   "precipvarname": args.precipvarname}
     else:
+        logging.error("Need a GCM file and an output file (or --shutdown)")
+        sys.exit(1)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(args.socket)
+    sock.sendall((json.dumps(request) + "\n").encode())
+    reply = json.loads(sock.makefile("rb").readline().decode())
+    sock.close()
+    if reply["status"] != "ok":
+        logging.error("Service reported: %s" % reply["message"])
+        sys.exit(1)
+    if "ofile" in reply:
+        sys.stdout.write(reply["ofile"] + "\n")
+
+
+def downscale(args):
+    if not downscale_available:
         logging.error("Downscaling not available!")
+        return
+    entries = list(args.downscale_variable or [])
+    if args.downscale_gcm:
+        entries.insert(0, (args.downscale_gcm[0], args.downscale_gcm[1],
+                           "air_temp_downscaled", "lapse"))
+    if not entries:
+        logging.error("Nothing to downscale, give -dgcm and/or -dvar")
+        sys.exit(1)
+    # pism_output_file keeps one handle per file, however many variables come from it
+    def read(f, v):
+        return pism_output_file.open(f)[v].read().squeeze()
+    # The orography and mask are read and analysed once for all variables
+    elev_hi = read(*args.downscale_hires)
+    elev_lo = read(*args.downscale_lores)
+    mask = read(*args.downscale_mask)
+    with profiling.timer("downscale_statics", "compute"):
+        statics = downscale_statics(elev_hi, elev_lo, mask, args.downscale_half_a_box)
+    journal = checkpoint.chunk_journal(
+        args.ofile,
+        [e[0] for e in entries] + [args.downscale_hires[0], args.downscale_lores[0],
+                                   args.downscale_mask[0]],
+        {"entries": entries, "half_a_box": args.downscale_half_a_box,
+         "dtype": args.downscale_dtype, "hires": args.downscale_hires,
+         "lores": args.downscale_lores, "mask": args.downscale_mask})
+    resumed = journal.resume()
+    if not resumed:
+        shutil.copy(entries[0][0], journal.part)
+    fout = pism_output_file.open(journal.part)
+    if not resumed:
+        # All outputs are laid out in the file in one go ...
+        for ifile, varname, outname, method in entries:
+            field_lo = pism_output_file.open(ifile)[varname]
+            attributes = {"long_name": "%s downscaled (%s) from %s" % (varname, method, ifile)}
+            units = getattr(field_lo, "units", None)
+            if units is not None:
+                attributes["units"] = units
+            ndim = len([n for n in field_lo.shape if n != 1])
+            dimensions = ("y", "x") if ndim == 2 else ("time", "y", "x")
+            fout.create_variable(outname, dimensions, None, dtype=np.dtype(args.downscale_dtype), **attributes)
+        fout.flush()
+        journal.start()
+    # ... and filled chunk by chunk, reading the next and writing the last
+    # chunk while one is downscaled
+    for ifile, varname, outname, method in entries:
+        field_lo = pism_output_file.open(ifile)[varname]
+        field_hi = fout.writable(outname)
+        if field_hi.ndim == 2:
+            keys = [(0, 1)]
+        else:
+            keys = pipeline.time_chunks(len(field_lo), fout.chunk_records)
+
+        def read_chunk(key):
+            t0, t1 = key
+            if field_hi.ndim == 2:
+                return field_lo.read().squeeze()
+            return field_lo[t0:t1].reshape((t1 - t0,) + field_hi.shape[1:])
+
+        def downscale_chunk(key, chunk):
+            t0, t1 = key
+            if method == "lapse":
+                # Straight into the mapped file, nothing is left to write
+                out = field_hi if field_hi.ndim == 2 else field_hi[t0:t1]
+                downscale_field(chunk, None, None, None, statics=statics, out=out.squeeze())
+                return None
+            return chunk.astype(args.downscale_dtype)
+
+        def write_chunk(key, chunk):
+            t0, t1 = key
+            if chunk is not None and field_hi.ndim == 2:
+                field_hi[:] = chunk
+            elif chunk is not None:
+                field_hi[t0:t1] = chunk.reshape((t1 - t0,) + field_hi.shape[1:])
+            fout.sync()
+            journal.mark(outname, key)
+        pipeline.chunk_pipeline(read_chunk, downscale_chunk, write_chunk,
+                                PIPELINE_DEPTH, PIPELINE_BYTES).run(journal.pending(outname, keys))
+    pism_output_file.close_all()
+    journal.publish()
+    logging.info("Downscaled %s written to %s" % (", ".join(e[2] for e in entries), args.ofile))
 
 
 #############
@@ -448,6 +1506,8 @@ def main():
     hdlr.setFormatter(fmt)
     logging.root.addHandler(hdlr)
     logging.root.setLevel(args.loglevel)
+    if args.profile:
+        profiling.enable()
     if args.command == "remap":
         remap(args)
     if args.command == "interpolate":
@@ -465,6 +1525,15 @@ def main():
             sys.exit(42)
     if args.command == "downscale":
         downscale(args)
+    if args.command == "export_to_gcm":
+        export_to_gcm(args)
+    if args.command == "serve":
+        serve(args)
+    if args.command == "request":
+        request_forcing(args)
+    if args.profile:
+        profiling.write_trace(args.profile)
+        logging.info("Profile written to %s" % args.profile)
 
 if __name__ == '__main__':
     with warnings.catch_warnings():
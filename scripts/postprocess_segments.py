@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Incremental post-processing of PISM restart segments.
+
+Every segment of a run_script_template.sh experiment leaves a
+${expid}_${icemod}_timeseries_<y0>-<y1>.nc and a
+${expid}_${icemod}_coupling_<y0>-<y1>.nc file in ${outdir}. This script
+keeps a small JSON state file next to them, recording which segments have
+already been processed and what their reductions (ice volume, ice area,
+cumulative SMB and discharge) were. On every call only the segments not yet
+in the state file are read; their timeseries records are appended to the
+combined timeseries file and the diagnostics file is rewritten from the
+(small) state.
+"""
+
+#################
+# IMPORT MODULES
+#################
+
+import argparse
+import glob
+import json
+import logging
+import numpy as np
+import os
+import re
+import shutil
+import subprocess
+import sys
+from scipy.io import netcdf
+import warnings
+
+try:
+    from sparse_remap import projected_cell_area
+    projected_cell_area_available = True
+except ImportError:
+    print("sparse_remap.py not found, areas without PISM's cell_area will be those on the map plane")
+    projected_cell_area_available = False
+
+###############
+# LOGGER STUFF
+###############
+
+
+# Colors for logger
+class bcolors:
+    HEADER = '\033[95m'
+    OKBLUE = '\033[94m'
+    OKGREEN = '\033[32m'
+    WARNING = '\033[33m'
+    FAIL = '\033[91m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+    UNDERLINE = '\033[4m'
+
+
+# Custom formatter
+class MyFormatter(logging.Formatter):
+
+    err_fmt = bcolors.FAIL + "ERROR: %(msg)s" + bcolors.ENDC
+    dbg_fmt = bcolors.WARNING + \
+        "DBG: %(module)s: %(lineno)d: %(msg)s" + bcolors.ENDC
+    info_fmt = bcolors.OKGREEN + "INFO: %(msg)s" + bcolors.ENDC
+    warn_fmt = bcolors.FAIL + "WARNING: %(msg)s" + bcolors.ENDC
+
+    def __init__(self, fmt="%(levelno)s: %(msg)s"):
+        logging.Formatter.__init__(self, fmt)
+
+    def format(self, record):
+        format_orig = self._fmt
+        if record.levelno == logging.DEBUG:
+            self._fmt = MyFormatter.dbg_fmt
+        elif record.levelno == logging.INFO:
+            self._fmt = MyFormatter.info_fmt
+        elif record.levelno == logging.ERROR:
+            self._fmt = MyFormatter.err_fmt
+        elif record.levelno == logging.WARN:
+            self._fmt = MyFormatter.warn_fmt
+        result = logging.Formatter.format(self, record)
+        self._fmt = format_orig
+        return result
+
+#########
+# PARSER
+#########
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Incrementally combines the timeseries and coupling files of PISM restart segments")
+    parser.add_argument("outdir", help="The directory the segments are written to (${outdir} in the run script)")
+    parser.add_argument("expid", help="The experiment id")
+    parser.add_argument("--icemod", default="pismr",
+                        help="The ice model executable name used in the file names, defaults to pismr")
+    parser.add_argument("--state", default=None,
+                        help="The state file, defaults to ${outdir}/${expid}_${icemod}_postprocess_state.json")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Forget the state file and process all segments again")
+    parser.add_argument('--debug', help="lots of output for debugging",
+                        action="store_const", dest="loglevel", const=logging.DEBUG,
+                        default=logging.WARNING)
+    parser.add_argument("-v", "--verbose", help="increase output verbosity",
+                        action="store_const", dest="loglevel", const=logging.INFO)
+    return parser.parse_args()
+
+############
+# FUNCTIONS
+############
+
+# Years may be negative, e.g. ..._timeseries_-10000--9900.nc
+SEGMENT_REGEX = re.compile(r"_(-?\d+)-(-?\d+)\.nc$")
+DIAGNOSTICS = ["ice_volume", "ice_area", "smb_cumulative", "discharge_cumulative"]
+
+
+def find_segments(outdir, expid, icemod, kind):
+    """
+    Returns a list of (y0, y1, filename) for all files of one kind
+    ("timeseries" or "coupling"), sorted by start year.
+    """
+    segments = []
+    for f in glob.glob(os.path.join(outdir, "%s_%s_%s_*.nc" % (expid, icemod, kind))):
+        match = SEGMENT_REGEX.search(f)
+        if match:
+            segments.append((int(match.group(1)), int(match.group(2)), f))
+    return sorted(segments)
+
+
+def empty_state():
+    return {"segments": [], "offsets": {"smb_cumulative": 0.0,
+                                        "discharge_cumulative": 0.0}}
+
+
+def load_state(state_file):
+    if not os.path.exists(state_file):
+        return empty_state()
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def save_state(state, state_file):
+    # Write to a temporary file first, so an interrupted job never leaves
+    # a truncated state file behind
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(state, f, indent=1)
+    os.rename(tmp_file, state_file)
+
+
+def coupling_cell_area(fin):
+    """
+    Area on the sphere of the cells of an open PISM output file: PISM's
+    cell_area if it was written, otherwise computed from x, y, lat and the
+    grid mapping. The map plane dx*dy is off by up to ~10% on the polar
+    stereographic Greenland grid.
+    """
+    if "cell_area" in fin.variables:
+        area = np.array(fin.variables["cell_area"].data, dtype=np.float64)
+        return area.reshape((-1,) + area.shape[-2:])[-1]
+    x = fin.variables["x"].data
+    y = fin.variables["y"].data
+    if projected_cell_area_available and "lat" in fin.variables:
+        mapping = fin.variables["mapping"]._attributes if "mapping" in fin.variables else None
+        return projected_cell_area(x, y, np.array(fin.variables["lat"].data, dtype=np.float64),
+                                   mapping)
+    logging.warning("%s has no cell_area and no lat, using the area on the map plane" % fin.filename)
+    return abs(float(x[1] - x[0]) * float(y[1] - y[0]))
+
+
+def reduce_coupling_file(filename, offsets):
+    """
+    Reduces one coupling (-extra_file) segment to a few numbers per record.
+
+    The cumulative fields are reset at the start of each PISM run, so the
+    running totals of all earlier segments (offsets) are added to them.
+    Only one time record is held in memory at a time.
+    """
+    fin = netcdf.netcdf_file(filename, "r")
+    cell_area = coupling_cell_area(fin)
+    times = fin.variables["time"].data
+    time_units = getattr(fin.variables["time"], "units", b"seconds since 1-1-1")
+    if isinstance(time_units, bytes):
+        time_units = time_units.decode()
+    records = {"time": [float(t) for t in times], "time_units": time_units}
+    for name in DIAGNOSTICS:
+        records[name] = []
+    for t in range(len(times)):
+        thk = fin.variables["thk"].data[t]
+        if "mask" in fin.variables:
+            # 2: grounded ice, 3: floating ice
+            mask = fin.variables["mask"].data[t]
+            icy = (mask == 2) | (mask == 3)
+        else:
+            icy = thk > 0
+        area = np.broadcast_to(cell_area, thk.shape)
+        records["ice_volume"].append(float(np.sum(thk[icy] * area[icy], dtype=np.float64)))
+        records["ice_area"].append(float(np.sum(area[icy], dtype=np.float64)))
+        for name, varname in (("smb_cumulative", "climatic_mass_balance_cumulative"),
+                              ("discharge_cumulative", "discharge_flux_cumulative")):
+            if varname in fin.variables:
+                total = float(np.sum(fin.variables[varname].data[t] * area, dtype=np.float64))
+            else:
+                total = 0.0
+            records[name].append(offsets[name] + total)
+    fin.close()
+    return records
+
+
+def record_times(filename):
+    """The time values of a file, read without mapping it."""
+    fin = netcdf.netcdf_file(filename, "r", mmap=False)
+    times = np.array(fin.variables["time"].data, dtype=np.float64)
+    fin.close()
+    return times
+
+
+def append_timeseries(segment_file, combined_file):
+    """
+    Appends the records of one timeseries segment to the combined file.
+    ncks --rec_apn writes only the new records, in place, so the cost does
+    not grow with the length of the experiment. Records that are not later
+    than the last one in the combined file are left out: consecutive
+    segments both write their boundary year, and a job killed after the
+    append but before its state was saved appends the same segment again.
+    """
+    if not os.path.exists(combined_file):
+        # Copied under another name first, so a killed copy never looks
+        # like a combined file
+        tmp_file = combined_file + ".tmp"
+        shutil.copy(segment_file, tmp_file)
+        os.rename(tmp_file, combined_file)
+        return
+    new = np.nonzero(record_times(segment_file) > record_times(combined_file)[-1])[0]
+    if len(new) == 0:
+        logging.info("All records of %s are already in %s" % (segment_file, combined_file))
+        return
+    subprocess.check_call(["ncks", "-A", "-q", "--rec_apn", "-d", "time,%d," % new[0],
+                           segment_file, combined_file])
+
+
+def write_diagnostics(state, ofile):
+    times, values = [], dict((name, []) for name in DIAGNOSTICS)
+    for segment in state["segments"]:
+        times.extend(segment["time"])
+        for name in DIAGNOSTICS:
+            values[name].extend(segment[name])
+    fout = netcdf.netcdf_file(ofile + ".tmp", "w")
+    fout.createDimension("time", None)
+    time = fout.createVariable("time", "d", ("time",))
+    time.units = state["segments"][0]["time_units"]
+    time[:] = times
+    attrs = {"ice_volume": ("m3", "Ice volume"),
+             "ice_area": ("m2", "Ice covered area"),
+             "smb_cumulative": ("kg", "Cumulative climatic mass balance since experiment start"),
+             "discharge_cumulative": ("kg", "Cumulative discharge since experiment start")}
+    for name in DIAGNOSTICS:
+        var = fout.createVariable(name, "d", ("time",))
+        var.units, var.long_name = attrs[name]
+        var[:] = values[name]
+    fout.close()
+    os.rename(ofile + ".tmp", ofile)
+
+
+def postprocess(outdir, expid, icemod="pismr", state_file=None, rebuild=False):
+    prefix = os.path.join(outdir, "%s_%s" % (expid, icemod))
+    if state_file is None:
+        state_file = prefix + "_postprocess_state.json"
+    combined_timeseries = prefix + "_timeseries.nc"
+    diagnostics_file = prefix + "_diagnostics.nc"
+    if rebuild:
+        for f in (state_file, combined_timeseries):
+            if os.path.exists(f):
+                os.remove(f)
+    state = load_state(state_file)
+    done = set((s["y0"], s["y1"]) for s in state["segments"])
+    last_end = state["segments"][-1]["y1"] if state["segments"] else None
+    timeseries = dict(((y0, y1), f) for y0, y1, f in find_segments(outdir, expid, icemod, "timeseries"))
+    new_segments = [s for s in find_segments(outdir, expid, icemod, "coupling")
+                    if (s[0], s[1]) not in done]
+    if not new_segments:
+        logging.info("No new segments found in %s" % outdir)
+        return state
+    for y0, y1, coupling_file in new_segments:
+        if last_end is not None and y0 < last_end:
+            logging.error("Segment %s-%s starts before the last processed segment ends (%s), rerun with --rebuild" % (y0, y1, last_end))
+            sys.exit(1)
+        logging.info("Processing segment %s-%s" % (y0, y1))
+        segment = reduce_coupling_file(coupling_file, state["offsets"])
+        segment["y0"], segment["y1"] = y0, y1
+        if (y0, y1) in timeseries:
+            append_timeseries(timeseries[(y0, y1)], combined_timeseries)
+        else:
+            logging.warning("No timeseries file for segment %s-%s" % (y0, y1))
+        for name in ("smb_cumulative", "discharge_cumulative"):
+            if segment[name]:
+                state["offsets"][name] = segment[name][-1]
+        state["segments"].append(segment)
+        last_end = y1
+        # Save after every segment, so a killed job only redoes the segment
+        # it was working on
+        save_state(state, state_file)
+    write_diagnostics(state, diagnostics_file)
+    logging.info("Diagnostics written to %s" % diagnostics_file)
+    return state
+
+
+def main():
+    args = parse_arguments()
+    fmt = MyFormatter()
+    hdlr = logging.StreamHandler(sys.stdout)
+    hdlr.setFormatter(fmt)
+    logging.root.addHandler(hdlr)
+    logging.root.setLevel(args.loglevel)
+    postprocess(args.outdir, args.expid, args.icemod, args.state, args.rebuild)
+
+if __name__ == '__main__':
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        main()
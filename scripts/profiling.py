@@ -0,0 +1,134 @@
+# coding: utf-8
+"""
+Low-overhead instrumentation for the pism_tools scripts.
+
+Switched off by default. When off, timer() hands back a shared no-op
+context manager and count() returns immediately, so both can stay in
+the code paths. When switched on (--profile FILE in the command line
+tools), timings for the read, compute and write stages, counters (cells
+processed, bytes read/written, cache hits, ...) and the peak memory are
+collected and can be written out as a Chrome trace (chrome://tracing or
+https://ui.perfetto.dev), which is plain JSON.
+
+Usage:
+
+    import profiling
+    profiling.enable()
+    with profiling.timer("read temperature", "read"):
+        data = ...
+    profiling.count("bytes_read", data.nbytes)
+    profiling.write_trace("profile.json")
+"""
+
+import json
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:             # Not available on Windows
+    resource = None
+
+_enabled = False
+_events = []
+_counters = {}
+_stage_totals = {}
+_lock = threading.Lock()
+_t0 = time.time()
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    def __init__(self, name, stage):
+        self.name = name
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.time()
+        event = {"name": self.name,
+                 "cat": self.stage,
+                 "ph": "X",
+                 "ts": (self.start - _t0) * 1e6,
+                 "dur": (end - self.start) * 1e6,
+                 "pid": os.getpid(),
+                 "tid": threading.current_thread().ident}
+        with _lock:
+            _events.append(event)
+            _stage_totals[self.stage] = _stage_totals.get(self.stage, 0.0) + end - self.start
+        return False
+
+
+def enable():
+    global _enabled, _t0
+    _enabled = True
+    _t0 = time.time()
+
+
+def enabled():
+    return _enabled
+
+
+def timer(name, stage="compute"):
+    """
+    Keyword Arguments:
+    name  -- what is being timed, shows up as the event name in the trace
+    stage -- one of "read", "compute", "write" (or anything else), totals are summed per stage
+    """
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name, stage)
+
+
+def count(name, n=1):
+    """Adds n to the counter name. Call it once per chunk, not once per cell."""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def peak_memory():
+    """Peak resident set size of this process in bytes (None if unknown)."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if os.uname()[0] == "Darwin":
+        return maxrss
+    return maxrss * 1024
+
+
+def summary():
+    with _lock:
+        return {"wall_time": time.time() - _t0,
+                "stage_totals": dict(_stage_totals),
+                "counters": dict(_counters),
+                "peak_memory_bytes": peak_memory()}
+
+
+def write_trace(filename):
+    """Writes all events in Chrome trace format, the summary goes into otherData."""
+    info = summary()
+    now = (time.time() - _t0) * 1e6
+    with _lock:
+        events = list(_events)
+    for name, value in sorted(info["counters"].items()):
+        events.append({"name": name, "ph": "C", "ts": now, "pid": os.getpid(),
+                       "args": {name: value}})
+    with open(filename, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms",
+                   "otherData": info}, f, indent=1)
@@ -68,6 +68,11 @@ source /etc/bashrc && echo "done!"
 icemod=pismr
 
 coupling=0			# PG: Coupling to GCM, 1 True, 0 False
+# When coupling, the forcing is prepared by a resident service that
+# keeps remapping weights etc. in memory, start it once per experiment:
+#   python pism_input_from_gcm.py serve -s ${forcing_socket} -igrid <griddes> <pism input file>
+forcing_socket=${FORCING_SOCKET:-/tmp/${USER}_pism_forcing.sock}
+gcm_outfile=${GCM_OUTFILE}	# GCM output of the last coupling interval, set by the coupler
 
 ########################################
 # DIRECTORY STRUCTURES
@@ -88,6 +93,10 @@ pooldir=/work/ollie/pgierz/pool_pism/
 subpool=examples_greenland
 
 numproc=72			# Number of processors to use
+# 1: numproc and skip_max are chosen by tune_allocation.py from the
+# performance of earlier segments (see ${outdir}/${expid}_${icemod}_performance.txt),
+# numproc at most ${SLURM_NTASKS}; the values set here are used until there is a history
+autotune=0
 execution_command="/global/opt/slurm/default/bin/srun --mpi=pmi2"
 
 
@@ -184,6 +193,15 @@ else
 fi
 
 
+if [[ $autotune -eq 1 ]]
+then
+    eval "$(python ${scriptdir}/tune_allocation.py -Mx $xres_ice -My $yres_ice \
+		   --outdir ${outdir} --expid ${expid} --icemod ${icemod} \
+		   --max-procs ${SLURM_NTASKS:-$numproc} --shell)"
+    echo "Using numproc=$numproc skip_max=$skip_max"
+fi
+
+
 z_spacing_equal=1		# 1: True, 0:False
 if [[ $z_spacing_equal -eq 1 ]]
 then
@@ -256,6 +274,10 @@ case $atmosphere in
 	atmo_flag=" -atmosphere given"
 	extra_file=${indir}/atmo_given_file.nc
 	atmo_flag_extra=" -atmosphere_given_file $extra_file"
+	if [[ ${coupling} -eq 1 ]]
+	then
+	    python ${scriptdir}/pism_input_from_gcm.py request -s ${forcing_socket} ${gcm_outfile} ${extra_file} || exit 42
+	fi
 	;;
     "yearly_cycle")
 	echo "Atmosphere --> Ice coupling type being used: |>>> yearly_cycle <<<|"
@@ -589,6 +611,7 @@ else
     prep_indir
     prep_workdir
     cd ${workdir}
+    segment_start=$(date +%s)
     $execution_command -n $numproc $icemod -i $input_file_name \
 		       $bootstrap_opt \
 		       $resolution_opt \
@@ -599,9 +622,38 @@ else
 		       -ts_file $ts_file_name -ts_times ${current_year}:yearly:${current_end} \
 		       -extra_file $ex_file_name -extra_times ${current_year}:${ex_interval}:${current_end} -extra_vars $ex_vars \
 		       -o $output_file_name -o_size big
+    pism_status=$?
+    # One line per segment for tune_allocation.py; a run that failed would
+    # log the whole segment with the wall time of its crash
+    performance_log=${outdir}/${expid}_${icemod}_performance.txt
+    if [ $pism_status -eq 0 ] && [ -f $output_file_name ]
+    then
+	if [ ! -f ${performance_log} ]
+	then
+	    echo "# y0 y1 Mx My Mz numproc skip_max seconds" > ${performance_log}
+	fi
+	echo "$current_year $current_end $xres_ice $yres_ice $zres_ice $numproc $skip_max $(( $(date +%s) - segment_start ))" >> ${performance_log}
+    else
+	echo "$icemod exited with status $pism_status, not logging its performance"
+    fi
 fi
 # Clean Up
 mv $ts_file_name $ex_file_name $output_file_name $outdir
+
+# Append this segment to the combined timeseries and diagnostics. Only
+# the new segment is read, earlier ones are remembered in a state file.
+postprocess=1			# 1 True, 0 False
+if [[ $postprocess -eq 1 ]]
+then
+    # A failed run leaves a partial coupling file behind, which would be
+    # recorded as done and never be replaced by a complete rerun
+    if [[ ${pism_status:-1} -eq 0 ]]
+    then
+	python ${scriptdir}/postprocess_segments.py ${outdir} ${expid} --icemod ${icemod} -v
+    else
+	echo "$icemod did not finish, not post-processing this segment"
+    fi
+fi
 # Go back
 cd ${scriptdir}
 
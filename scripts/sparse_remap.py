@@ -0,0 +1,357 @@
+# coding: utf-8
+"""
+In-process remapping with sparse matrices, an alternative to calling cdo.
+
+A remapping is a sparse matrix W of shape (n_dst, n_src): dst = W . src.
+The weights either come from a SCRIP/CDO weight file (e.g. cdo genbil,
+cdo gencon) or are built here from the grid coordinates:
+
+    bilinear       -- source on a regular lon/lat grid (ECHAM), destination
+                      points given by their centers
+    conservative   -- approximately first order conservative, source on a
+                      regular lon/lat grid, destination cells given by
+                      their corners. Every destination cell is subsampled
+                      with n x n points and each point is assigned to the
+                      source cell it falls in, so the weights of a
+                      destination cell sum to 1 and only converge to the
+                      exact overlap areas with n. Integrals are not
+                      conserved exactly, unlike with cdo remapcon.
+
+The destination grid is read by read_grid() from a CDO grid description
+(xvals/yvals, xbounds/ybounds), a SCRIP grid file (grid_center_lon/lat,
+grid_corner_lon/lat) or the PISM_xbounds_*/PISM_ybounds_* files in
+grid_output with their PISM_rlon_*/PISM_rlat_* centers.
+
+The matrix is kept in CSR format. remap_operator.apply() flattens all
+leading dimensions (time, variables, ...) into rows and remaps them with
+a single sparse product, so no per-record or per-variable loop and no
+external process is needed. Operators saved with save() keep the source
+and destination shapes and a hash of the destination grid in the same
+.npz file; fits() tells whether a loaded operator belongs to a grid.
+"""
+
+import hashlib
+import logging
+import os
+import numpy as np
+import scipy.sparse
+
+
+##########
+# CLASSES
+##########
+
+class remap_operator(object):
+    """
+    Keyword Arguments:
+    matrix    -- scipy.sparse matrix, shape (n_dst, n_src)
+    src_shape -- shape of a source field, e.g. (nlat, nlon)
+    dst_shape -- shape of a destination field, e.g. (ny, nx)
+    dst_hash  -- (default None) grid_hash() of the destination grid, if known
+    dst_lon, dst_lat -- (default None) destination points in degrees, if known instead
+    """
+    def __init__(self, matrix, src_shape, dst_shape, dst_hash=None, dst_lon=None, dst_lat=None):
+        self.matrix = scipy.sparse.csr_matrix(matrix)
+        self.src_shape = tuple(src_shape)
+        self.dst_shape = tuple(dst_shape)
+        self.dst_hash = dst_hash
+        self.dst_lon = dst_lon
+        self.dst_lat = dst_lat
+        if self.matrix.shape != (int(np.prod(dst_shape)), int(np.prod(src_shape))):
+            raise ValueError("Matrix shape %s does not fit %s -> %s"
+                             % (self.matrix.shape, src_shape, dst_shape))
+
+    def apply(self, field):
+        """
+        Remaps field of shape (..., *src_shape) to (..., *dst_shape). All
+        leading dimensions are stacked into one (n, n_src) array and
+        remapped with a single sparse product.
+        """
+        field = np.asarray(field)
+        lead = field.shape[:field.ndim - len(self.src_shape)]
+        if field.shape[len(lead):] != self.src_shape:
+            raise ValueError("Field shape %s does not end in %s" % (field.shape, self.src_shape))
+        stacked = field.reshape(-1, self.matrix.shape[1])
+        # (W . stacked^T)^T, scipy only knows sparse . dense
+        result = self.matrix.dot(stacked.T).T
+        return result.reshape(lead + self.dst_shape)
+
+    def fits(self, src_shape, grid):
+        """True if the operator remaps fields of src_shape onto grid (as from read_grid)."""
+        if self.src_shape != tuple(src_shape) or self.dst_shape != np.shape(grid["xvals"]):
+            return False
+        if self.dst_lon is not None:
+            lon_diff = (np.asarray(self.dst_lon) - grid["xvals"] + 180.) % 360. - 180.
+            return (np.allclose(lon_diff, 0., atol=1e-4) and
+                    np.allclose(self.dst_lat, grid["yvals"], atol=1e-4))
+        return self.dst_hash is not None and self.dst_hash == grid_hash(grid)
+
+    def save(self, filename):
+        """Saves matrix, shapes and destination hash in one .npz file."""
+        np.savez(filename, data=self.matrix.data, indices=self.matrix.indices,
+                 indptr=self.matrix.indptr, shape=self.matrix.shape,
+                 src_shape=self.src_shape, dst_shape=self.dst_shape,
+                 dst_hash=self.dst_hash or "")
+
+    @classmethod
+    def load(cls, filename):
+        """Reads an operator written by save(); KeyError for files without shapes."""
+        npz = np.load(filename)
+        try:
+            matrix = scipy.sparse.csr_matrix((npz["data"], npz["indices"], npz["indptr"]),
+                                             shape=tuple(npz["shape"]))
+            return cls(matrix, tuple(npz["src_shape"]), tuple(npz["dst_shape"]),
+                       str(npz["dst_hash"]) or None)
+        finally:
+            npz.close()
+
+    @classmethod
+    def from_scrip(cls, filename):
+        """Reads a SCRIP weight file as written by cdo gen* (1-based addresses)."""
+        from scipy.io import netcdf
+        fin = netcdf.netcdf_file(filename)
+        src = fin.variables["src_address"].data.astype(np.int64) - 1
+        dst = fin.variables["dst_address"].data.astype(np.int64) - 1
+        weights = fin.variables["remap_matrix"].data
+        if weights.ndim > 1:
+            # Only first order weights are used
+            weights = weights[:, 0]
+        # SCRIP grid dims are stored fastest varying first (nlon, nlat)
+        src_shape = tuple(fin.variables["src_grid_dims"].data[::-1])
+        dst_shape = tuple(fin.variables["dst_grid_dims"].data[::-1])
+        matrix = scipy.sparse.csr_matrix((weights.astype(np.float64), (dst, src)),
+                                         shape=(int(np.prod(dst_shape)), int(np.prod(src_shape))))
+        dst_lon, dst_lat = [_degrees(fin.variables["dst_grid_center_" + c]).reshape(dst_shape)
+                            for c in ("lon", "lat")]
+        fin.close()
+        return cls(matrix, src_shape, dst_shape, dst_lon=dst_lon, dst_lat=dst_lat)
+
+    @classmethod
+    def bilinear(cls, src_lon, src_lat, dst_lon, dst_lat):
+        """
+        Keyword Arguments:
+        src_lon, src_lat -- 1D coordinates of the regular source grid
+        dst_lon, dst_lat -- coordinates of the destination points (any shape)
+        """
+        lat_order = np.argsort(src_lat)
+        lat_sorted = np.asarray(src_lat, dtype=np.float64)[lat_order]
+        nlat, nlon = len(src_lat), len(src_lon)
+        # Periodic in longitude: append the first column again at +360
+        lon_ext = np.append(np.asarray(src_lon, dtype=np.float64), src_lon[0] + 360.)
+        lon = (np.ravel(dst_lon) - lon_ext[0]) % 360. + lon_ext[0]
+        lat = np.clip(np.ravel(dst_lat), lat_sorted[0], lat_sorted[-1])
+        j = np.clip(np.searchsorted(lon_ext, lon) - 1, 0, nlon - 1)
+        i = np.clip(np.searchsorted(lat_sorted, lat) - 1, 0, nlat - 2)
+        u = (lon - lon_ext[j]) / (lon_ext[j + 1] - lon_ext[j])
+        v = (lat - lat_sorted[i]) / (lat_sorted[i + 1] - lat_sorted[i])
+        i0, i1 = lat_order[i], lat_order[i + 1]
+        j1 = (j + 1) % nlon
+        rows = np.tile(np.arange(lon.size), 4)
+        cols = np.concatenate([i0 * nlon + j, i0 * nlon + j1, i1 * nlon + j1, i1 * nlon + j])
+        weights = np.concatenate([(1 - u) * (1 - v), u * (1 - v), u * v, (1 - u) * v])
+        matrix = scipy.sparse.csr_matrix((weights, (rows, cols)),
+                                         shape=(lon.size, nlat * nlon))
+        return cls(matrix, (nlat, nlon), np.shape(dst_lon))
+
+    @classmethod
+    def conservative(cls, src_lon, src_lat, dst_corner_lon, dst_corner_lat, subsamples=4):
+        """
+        Keyword Arguments:
+        src_lon, src_lat               -- 1D coordinates of the regular source grid
+        dst_corner_lon, dst_corner_lat -- corners of the destination cells, shape (..., 4),
+                                          ordered around the cell
+        subsamples                     -- (default 4) points per direction and destination cell
+        """
+        dst_shape = np.shape(dst_corner_lon)[:-1]
+        corner_lon = np.asarray(dst_corner_lon, dtype=np.float64).reshape(-1, 4)
+        corner_lat = np.asarray(dst_corner_lat, dtype=np.float64).reshape(-1, 4)
+        # Unwrap the corners of cells crossing the date line
+        corner_lon = corner_lon[:, :1] + (corner_lon - corner_lon[:, :1] + 180.) % 360. - 180.
+        ncells = corner_lon.shape[0]
+        nlat, nlon = len(src_lat), len(src_lon)
+        lat_order = np.argsort(src_lat)
+        lat_edges = cell_edges(np.asarray(src_lat)[lat_order], -90., 90.)
+        lon_edges = cell_edges(src_lon, src_lon[0] - 0.5 * (src_lon[1] - src_lon[0]), 0.)
+        lon_edges[-1] = lon_edges[0] + 360.
+        # Cell centered subsample positions in the unit square
+        s = (np.arange(subsamples) + 0.5) / subsamples
+        u, v = [a.ravel() for a in np.meshgrid(s, s)]
+        rows, cols = [], []
+        for uk, vk in zip(u, v):
+            # Bilinear position inside the quadrilateral of corners 0-1-2-3
+            c = np.array([(1 - uk) * (1 - vk), uk * (1 - vk), uk * vk, (1 - uk) * vk])
+            lon = corner_lon.dot(c)
+            lat = corner_lat.dot(c)
+            i = lat_order[np.clip(np.searchsorted(lat_edges, lat) - 1, 0, nlat - 1)]
+            j = np.clip(np.searchsorted(lon_edges, (lon - lon_edges[0]) % 360. + lon_edges[0]) - 1,
+                        0, nlon - 1)
+            rows.append(np.arange(ncells))
+            cols.append(i * nlon + j)
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        weights = np.full(rows.size, 1. / len(u))
+        # Duplicate (row, col) entries are summed by the conversion
+        matrix = scipy.sparse.coo_matrix((weights, (rows, cols)),
+                                         shape=(ncells, nlat * nlon)).tocsr()
+        return cls(matrix, (nlat, nlon), dst_shape)
+
+
+############
+# FUNCTIONS
+############
+
+def grid_hash(grid):
+    """md5 of the destination points and corners of a read_grid() grid."""
+    key = hashlib.md5()
+    for name in ("xvals", "yvals", "xbounds", "ybounds"):
+        if name in grid:
+            key.update(name.encode())
+            key.update(np.ascontiguousarray(grid[name], dtype=np.float64).tobytes())
+    return key.hexdigest()
+
+
+def _degrees(var):
+    """A SCRIP coordinate variable in degrees; cdo writes radians or degrees."""
+    units = getattr(var, "units", b"degrees")
+    if isinstance(units, bytes):
+        units = units.decode()
+    data = np.array(var.data, dtype=np.float64)
+    if units.startswith("radian"):
+        return np.degrees(data)
+    return data
+
+
+def cell_edges(centers, lower, upper):
+    """Edges halfway between the centers, closed by lower and upper."""
+    centers = np.asarray(centers, dtype=np.float64)
+    return np.concatenate([[lower], 0.5 * (centers[1:] + centers[:-1]), [upper]])
+
+
+def projected_cell_area(x, y, lat, mapping=None):
+    """
+    Area on the sphere of the cells of a projected grid such as PISM's,
+    with 1D x/y in meters and the 2D lat of the cells: dx*dy corrected by
+    the scale factor of the polar stereographic projection,
+    k = (1 + sin(standard_parallel)) / (1 + sin(lat)). mapping are the
+    attributes of the grid mapping variable; without a polar stereographic
+    one the area on the map plane is returned.
+    """
+    dxdy = abs(float(x[1] - x[0]) * float(y[1] - y[0]))
+    name = (mapping or {}).get("grid_mapping_name", b"")
+    if isinstance(name, bytes):
+        name = name.decode()
+    if name != "polar_stereographic":
+        logging.warning("No polar stereographic mapping, using the area on the map plane")
+        return dxdy
+    sin_lat = np.sin(np.radians(np.abs(lat)))
+    if "standard_parallel" in mapping:
+        standard_parallel = abs(float(np.ravel(mapping["standard_parallel"])[0]))
+        k = (1 + np.sin(np.radians(standard_parallel))) / (1 + sin_lat)
+    else:
+        k = 2 * float(np.ravel(mapping.get("scale_factor_at_projection_origin", 1.))[0]) / (1 + sin_lat)
+    return dxdy / k ** 2
+
+
+def read_griddes(filename):
+    """
+    Reads a CDO grid description file (as in grid_output/testgrid) into a
+    dict. Numbers are returned as numpy arrays, reshaped to (ysize, xsize)
+    or (ysize, xsize, nvertex) for curvilinear grids (or (gridsize,) and
+    (gridsize, nvertex) if the sizes are not given).
+    """
+    entries = {}
+    key = None
+    with open(filename) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            if "=" in line:
+                key, line = [part.strip() for part in line.split("=", 1)]
+                entries[key] = []
+            if key is not None:
+                entries[key].extend(line.split())
+    grid = {}
+    for key, values in entries.items():
+        try:
+            grid[key] = np.array(values, dtype=np.float64)
+        except ValueError:
+            grid[key] = " ".join(values).strip("'\"")
+    for key in ("gridsize", "xsize", "ysize", "nvertex"):
+        if key in grid:
+            grid[key] = int(grid[key][0])
+    if grid.get("gridtype") == "curvilinear":
+        if "xsize" in grid and "ysize" in grid:
+            shape = (grid["ysize"], grid["xsize"])
+        else:
+            # Unstructured list of cells
+            shape = (grid.get("gridsize", grid["xvals"].size),)
+        for key in ("xvals", "yvals"):
+            if key in grid:
+                grid[key] = grid[key].reshape(shape)
+        for key in ("xbounds", "ybounds"):
+            if key in grid:
+                grid[key] = grid[key].reshape(shape + (grid.get("nvertex", 4),))
+    logging.debug("Read %s grid with keys %s from %s"
+                  % (grid.get("gridtype"), sorted(grid), filename))
+    return grid
+
+
+def read_scrip_grid(filename):
+    """
+    Reads a SCRIP grid file (as written by cdo gridfile or the SCRIP
+    package) into a dict with the keys read_griddes gives: xvals/yvals of
+    shape (ny, nx) and xbounds/ybounds of shape (ny, nx, ncorners).
+    """
+    from scipy.io import netcdf
+    fin = netcdf.netcdf_file(filename)
+    # SCRIP grid dims are stored fastest varying first (nx, ny)
+    shape = tuple(int(n) for n in fin.variables["grid_dims"].data[::-1])
+    grid = {"gridtype": "curvilinear", "gridsize": int(np.prod(shape))}
+    if len(shape) == 2:
+        grid["ysize"], grid["xsize"] = shape
+    grid["xvals"] = _degrees(fin.variables["grid_center_lon"]).reshape(shape)
+    grid["yvals"] = _degrees(fin.variables["grid_center_lat"]).reshape(shape)
+    if "grid_corner_lon" in fin.variables:
+        ncorners = fin.variables["grid_corner_lon"].shape[-1]
+        grid["nvertex"] = ncorners
+        grid["xbounds"] = _degrees(fin.variables["grid_corner_lon"]).reshape(shape + (ncorners,))
+        grid["ybounds"] = _degrees(fin.variables["grid_corner_lat"]).reshape(shape + (ncorners,))
+    fin.close()
+    logging.debug("Read SCRIP grid of shape %s from %s" % (shape, filename))
+    return grid
+
+
+def read_pism_bounds(xbounds_file):
+    """
+    Reads the ASCII grid of PISM_Greenland_grid_*.m: xbounds_file is a
+    PISM_xbounds_* file, PISM_ybounds_*, PISM_rlon_* and PISM_rlat_* are
+    expected next to it. rlon/rlat hold the cell centers as (x, y), the
+    bounds one cell per line, x varying fastest, with the corners in
+    order around the cell.
+    """
+    directory, name = os.path.split(xbounds_file)
+    sibling = lambda kind: os.path.join(directory, name.replace("xbounds", kind))
+    xvals = np.loadtxt(sibling("rlon")).T
+    yvals = np.loadtxt(sibling("rlat")).T
+    shape = xvals.shape
+    xbounds = np.loadtxt(xbounds_file)
+    ybounds = np.loadtxt(sibling("ybounds"))
+    grid = {"gridtype": "curvilinear", "gridsize": xvals.size,
+            "ysize": shape[0], "xsize": shape[1], "nvertex": xbounds.shape[-1],
+            "xvals": xvals, "yvals": yvals,
+            "xbounds": xbounds.reshape(shape + (-1,)),
+            "ybounds": ybounds.reshape(shape + (-1,))}
+    logging.debug("Read PISM grid of shape %s from %s" % (shape, xbounds_file))
+    return grid
+
+
+def read_grid(filename):
+    """The destination grid in filename, which may be any format read_* above reads."""
+    with open(filename, "rb") as f:
+        magic = f.read(3)
+    if magic in (b"CDF", b"\x89HD"):
+        return read_scrip_grid(filename)
+    if "PISM_xbounds_" in os.path.basename(filename):
+        return read_pism_bounds(filename)
+    return read_griddes(filename)
@@ -28,7 +28,8 @@ if [ $# -lt 5 ] ; then
   echo "    spinup.sh PROCS CLIMATE DURATION GRID DYNAMICS [OUTFILE] [BOOTFILE]"
   echo
   echo "  where:"
-  echo "    PROCS     = 1,2,3,... is number of MPI processes"
+  echo "    PROCS     = 1,2,3,... is number of MPI processes, or auto to let"
+  echo "                tune_allocation.py choose it from the runs in PERFLOG"
   echo "    CLIMATE   in $CLIMLIST"
   echo "    DURATION  = model run time in years; does '-ys -DURATION -ye 0'"
   echo "    GRID      in $GRIDLIST (km)"
@@ -58,6 +59,11 @@ if [ $# -lt 5 ] ; then
   echo "    REGRIDFILE   set to file name to regrid from; defaults to empty (no regrid)"
   echo "    REGRIDVARS   desired -regrid_vars; applies *if* REGRIDFILE set;"
   echo "                   defaults to 'bmelt,enthalpy,litho_temp,thk,tillwat'"
+  echo "    SKIPMAX      sets -skip_max; defaults to 10 (40, 20 km), 20 (10, 5, 3 km)"
+  echo "                   or 50 (2 km)"
+  echo "    PERFLOG      performance log; if set, every run appends its grid, process"
+  echo "                   count and wall clock time to it, needed for PROCS=auto"
+  echo "    MAXPROCS     largest process count PROCS=auto may choose; defaults to 288"
   echo
   echo "example usage 1:"
   echo
@@ -107,10 +113,16 @@ else
   exit
 fi
 
-# decide on grid and skip from argument 4
-COARSESKIP=10
-FINESKIP=20
-FINESTSKIP=50
+# decide on grid and skip from argument 4; SKIPMAX overrides the default
+if [ -n "${SKIPMAX:+1}" ] ; then  # check if env var is already set
+  COARSESKIP=$SKIPMAX
+  FINESKIP=$SKIPMAX
+  FINESTSKIP=$SKIPMAX
+else
+  COARSESKIP=10
+  FINESKIP=20
+  FINESTSKIP=50
+fi
 VDIMS="-Lz 4000 -Lbz 2000 -skip -skip_max "
 COARSEVGRID="-Mz 101 -Mbz 11 -z_spacing equal ${VDIMS} ${COARSESKIP}"
 FINEVGRID="-Mz 201 -Mbz 21 -z_spacing equal ${VDIMS} ${FINESKIP}"
@@ -151,6 +163,21 @@ else
   exit
 fi
 
+# choose the process count from earlier runs
+if [ "$NN" = "auto" ] ; then
+  if [ -z "${PERFLOG}" ] ; then  # check if env var is NOT set
+    echo "$SCRIPTNAME PROCS=auto needs PERFLOG ... ENDING NOW"
+    exit 1
+  fi
+  eval "$(python $(dirname "$0")/tune_allocation.py -Mx $myMx -My $myMy --perf $PERFLOG --max-procs ${MAXPROCS:-288} --shell)"
+  if [ -z "${numproc}" ] ; then
+    echo "$SCRIPTNAME not enough earlier runs in $PERFLOG to choose, give PROCS ... ENDING NOW"
+    exit 1
+  fi
+  NN=$numproc
+  echo "$SCRIPTNAME  PROCS=auto: $NN processes (tune_allocation.py suggests -skip_max $skip_max)"
+fi
+
 # set stress balance from argument 5
 if [ -n "${PARAM_SIAE:+1}" ] ; then  # check if env var is already set
   PHYS="-calving ocean_kill -ocean_kill_file ${PISM_DATANAME} -sia_e ${PARAM_SIAE}"
@@ -315,5 +342,18 @@ fi
 # construct command
 cmd="$PISM_MPIDO $NN $PISM -i $INNAME -bootstrap -Mx $myMx -My $myMy $vgrid $RUNSTARTEND $regridcommand $COUPLER $PHYS $DIAGNOSTICS -o $OUTNAME"
 echo
+START=$(date +%s)
 $PISM_DO $cmd
+pism_status=$?
+
+# one line per successful run for tune_allocation.py
+if [ -n "${PERFLOG}" ] && [ -z "${PISM_DO}" ] && [ $pism_status -eq 0 ] && [ -f "$OUTNAME" ] ; then
+  if [ ! -f "$PERFLOG" ] ; then
+    echo "# y0 y1 Mx My Mz numproc skip_max seconds" > $PERFLOG
+  fi
+  myMz=$(echo $vgrid | sed 's/.*-Mz \([0-9]*\).*/\1/')
+  mySkip=$(echo $vgrid | sed 's/.*-skip_max \([0-9]*\).*/\1/')
+  echo "-$DURATION 0 $myMx $myMy $myMz $NN $mySkip $(( $(date +%s) - START ))" >> $PERFLOG
+fi
+exit $pism_status
 
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Chooses the process count and -skip_max for the next PISM segment from
+the performance of the earlier ones.
+
+Every segment run by run_script_template.sh (or spinup.sh with PERFLOG
+set) appends one line to a performance log:
+
+    # y0 y1 Mx My Mz numproc skip_max seconds
+
+Main output files of earlier segments (${expid}_${icemod}_main_<y0>-<y1>.nc)
+are used as well: PISM stores the wall clock and processor hours in the
+attributes of their run_stats variable. The model years of a segment are
+taken from its timeseries file if there is one, so segments that stopped
+early are not counted as complete.
+
+The wall clock seconds per model year are fitted with a simple strong
+scaling model, N being the number of grid columns (Mx * My) and p the
+process count:
+
+    t(N, p) = a * N / p  +  b * N  +  c * log2(p)
+
+a is the work that is spread over the processes, b the part that is not
+(Amdahl's serial fraction) and c the cost of global communication, which
+grows with the number of processes. The coefficients are fitted with
+non-negative least squares on the relative error. a and b can only be
+told apart if the segments ran with at least two different process
+counts; run_script_template.sh always uses the same numproc, so unless
+--prior-a gives a, nothing is recommended until there is such a history.
+The parallel efficiency
+of p processes is t(N, 1) / (p * t(N, p)); the largest process count
+(whole nodes, or a power of two below one node) that keeps it above
+--min-efficiency is recommended.
+
+-skip_max is the value with the best throughput (relative to the model)
+among earlier segments on the same grid. Without such segments it is
+scaled from 10 at 76 x 141 (20 km) with the grid spacing, i.e. with
+sqrt(N), which gives the 5, 10, 20, 40 of run_script_template.sh.
+"""
+
+#################
+# IMPORT MODULES
+#################
+
+import argparse
+import logging
+import math
+import numpy as np
+import os
+import sys
+from scipy.io import netcdf
+from scipy.optimize import nnls
+import warnings
+
+from postprocess_segments import find_segments
+
+###############
+# LOGGER STUFF
+###############
+
+
+# Colors for logger
+class bcolors:
+    HEADER = '\033[95m'
+    OKBLUE = '\033[94m'
+    OKGREEN = '\033[32m'
+    WARNING = '\033[33m'
+    FAIL = '\033[91m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+    UNDERLINE = '\033[4m'
+
+
+# Custom formatter
+class MyFormatter(logging.Formatter):
+
+    err_fmt = bcolors.FAIL + "ERROR: %(msg)s" + bcolors.ENDC
+    dbg_fmt = bcolors.WARNING + \
+        "DBG: %(module)s: %(lineno)d: %(msg)s" + bcolors.ENDC
+    info_fmt = bcolors.OKGREEN + "INFO: %(msg)s" + bcolors.ENDC
+    warn_fmt = bcolors.FAIL + "WARNING: %(msg)s" + bcolors.ENDC
+
+    def __init__(self, fmt="%(levelno)s: %(msg)s"):
+        logging.Formatter.__init__(self, fmt)
+
+    def format(self, record):
+        format_orig = self._fmt
+        if record.levelno == logging.DEBUG:
+            self._fmt = MyFormatter.dbg_fmt
+        elif record.levelno == logging.INFO:
+            self._fmt = MyFormatter.info_fmt
+        elif record.levelno == logging.ERROR:
+            self._fmt = MyFormatter.err_fmt
+        elif record.levelno == logging.WARN:
+            self._fmt = MyFormatter.warn_fmt
+        result = logging.Formatter.format(self, record)
+        self._fmt = format_orig
+        return result
+
+#########
+# PARSER
+#########
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Recommends numproc and skip_max for the next PISM segment from the performance of earlier segments")
+    parser.add_argument("-Mx", type=int, required=True, help="Grid points in x of the next segment")
+    parser.add_argument("-My", type=int, required=True, help="Grid points in y of the next segment")
+    parser.add_argument("--outdir", help="Output directory of the experiment (${outdir} in the run script)")
+    parser.add_argument("--expid", help="The experiment id, needed with --outdir")
+    parser.add_argument("--icemod", default="pismr",
+                        help="The ice model executable name used in the file names, defaults to pismr")
+    parser.add_argument("--perf", action="append", default=[],
+                        help="Additional performance log(s), can be given several times")
+    parser.add_argument("--max-procs", type=int, default=288, dest="max_procs",
+                        help="Largest process count that may be used, defaults to 288")
+    parser.add_argument("--cores-per-node", type=int, default=36, dest="cores_per_node",
+                        help="Cores per node, defaults to 36")
+    parser.add_argument("--min-efficiency", type=float, default=0.5, dest="min_efficiency",
+                        help="Lowest acceptable parallel efficiency, defaults to 0.5")
+    parser.add_argument("--prior-a", type=float, dest="prior_a",
+                        help="Parallel work a in seconds per grid column and model year, "
+                        "if the history has only one process count")
+    parser.add_argument("--shell", action="store_true",
+                        help="Only print numproc=... and skip_max=... for eval in a shell script, "
+                        "nothing if the history is not enough (the expected efficiency goes to stderr)")
+    parser.add_argument('--debug', help="lots of output for debugging",
+                        action="store_const", dest="loglevel", const=logging.DEBUG,
+                        default=logging.WARNING)
+    parser.add_argument("-v", "--verbose", help="increase output verbosity",
+                        action="store_const", dest="loglevel", const=logging.INFO)
+    return parser.parse_args()
+
+############
+# FUNCTIONS
+############
+
+PERFORMANCE_LOG = "%s_%s_performance.txt"
+PERFORMANCE_FIELDS = ["y0", "y1", "Mx", "My", "Mz", "numproc", "skip_max", "seconds"]
+SECONDS_PER_YEAR = 365 * 86400.
+# -skip_max of run_script_template.sh at 20 km (76 x 141)
+REFERENCE_SKIP_MAX = 10
+REFERENCE_COLUMNS = 76 * 141
+
+
+def read_performance_log(filename):
+    """Returns one dict per segment line of a performance log."""
+    samples = []
+    with open(filename) as f:
+        for line in f:
+            line = line.split("#")[0].split()
+            if not line:
+                continue
+            if len(line) != len(PERFORMANCE_FIELDS):
+                logging.warning("Skipping malformed line in %s: %s" % (filename, " ".join(line)))
+                continue
+            sample = dict(zip(PERFORMANCE_FIELDS, [float(v) for v in line]))
+            sample["years"] = sample["y1"] - sample["y0"]
+            sample["source"] = filename
+            samples.append(sample)
+    return samples
+
+
+def timeseries_years(filename):
+    """Model years covered by a PISM timeseries file (None if it cannot be told)."""
+    fin = netcdf.netcdf_file(filename, "r")
+    try:
+        time = fin.variables["time"]
+        if len(time.data) < 2:
+            return None
+        units = getattr(time, "units", b"seconds")
+        if isinstance(units, bytes):
+            units = units.decode()
+        span = float(time.data[-1] - time.data[0])
+        if units.startswith("seconds"):
+            return span / SECONDS_PER_YEAR
+        if units.startswith("days"):
+            return span / 365.
+        return span
+    finally:
+        fin.close()
+
+
+def read_run_stats(outdir, expid, icemod):
+    """One dict per main output file that has PISM's run_stats."""
+    samples = []
+    timeseries = dict(((y0, y1), f) for y0, y1, f in find_segments(outdir, expid, icemod, "timeseries"))
+    for y0, y1, filename in find_segments(outdir, expid, icemod, "main"):
+        fin = netcdf.netcdf_file(filename, "r")
+        try:
+            if "run_stats" not in fin.variables:
+                continue
+            stats = fin.variables["run_stats"]
+            wall_hours = float(getattr(stats, "wall_clock_hours", 0))
+            processor_hours = float(getattr(stats, "processor_hours", 0))
+            if wall_hours <= 0 or processor_hours <= 0:
+                continue
+            sample = {"y0": y0, "y1": y1,
+                      "Mx": len(fin.variables["x"].data),
+                      "My": len(fin.variables["y"].data),
+                      "Mz": len(fin.variables["z"].data) if "z" in fin.variables else 0,
+                      "numproc": round(processor_hours / wall_hours),
+                      "skip_max": None,
+                      "seconds": wall_hours * 3600.,
+                      "years": y1 - y0,
+                      "source": filename}
+        finally:
+            fin.close()
+        if (y0, y1) in timeseries:
+            years = timeseries_years(timeseries[(y0, y1)])
+            if years:
+                sample["years"] = years
+        samples.append(sample)
+    return samples
+
+
+def collect_samples(args):
+    samples = []
+    perf_files = list(args.perf)
+    if args.outdir:
+        if not args.expid:
+            logging.error("--outdir needs --expid")
+            sys.exit(1)
+        perf_files.append(os.path.join(args.outdir, PERFORMANCE_LOG % (args.expid, args.icemod)))
+        for f in perf_files:
+            if os.path.exists(f):
+                samples.extend(read_performance_log(f))
+        logged = set((s["y0"], s["y1"]) for s in samples)
+        # Segments already in a performance log are not counted twice
+        samples.extend(s for s in read_run_stats(args.outdir, args.expid, args.icemod)
+                       if (s["y0"], s["y1"]) not in logged)
+    else:
+        for f in perf_files:
+            samples.extend(read_performance_log(f))
+    samples = [s for s in samples if s["years"] > 0 and s["seconds"] > 0 and s["numproc"] >= 1]
+    for s in samples:
+        s["columns"] = s["Mx"] * s["My"]
+        s["seconds_per_year"] = s["seconds"] / s["years"]
+    logging.info("Found %d segments" % len(samples))
+    return samples
+
+
+def _scaling_terms(columns, procs):
+    columns, procs = np.broadcast_arrays(np.asarray(columns, dtype=np.float64),
+                                         np.asarray(procs, dtype=np.float64))
+    return np.column_stack([columns / procs, columns, np.log2(procs)])
+
+
+def fit_scaling_model(samples, prior_a=None):
+    """
+    Coefficients (a, b, c) of t = a N/p + b N + c log2(p), fitted to the
+    relative error. With prior_a, a is fixed and only b and c are fitted.
+    """
+    terms = _scaling_terms([s["columns"] for s in samples], [s["numproc"] for s in samples])
+    observed = np.array([s["seconds_per_year"] for s in samples])
+    if prior_a is None:
+        coefficients, residual = nnls(terms / observed[:, None], np.ones(len(samples)))
+    else:
+        bc, residual = nnls(terms[:, 1:] / observed[:, None],
+                            1. - prior_a * terms[:, 0] / observed)
+        coefficients = np.concatenate([[prior_a], bc])
+    logging.info("Fitted a=%.3g s, b=%.3g s, c=%.3g s (relative rms %.2f)"
+                 % (tuple(coefficients) + (residual / math.sqrt(len(samples)),)))
+    return coefficients
+
+
+def seconds_per_year(coefficients, columns, procs):
+    return _scaling_terms(np.atleast_1d(columns), np.atleast_1d(procs)).dot(coefficients)
+
+
+def parallel_efficiency(coefficients, columns, procs):
+    procs = np.atleast_1d(procs).astype(np.float64)
+    serial = seconds_per_year(coefficients, columns, 1)
+    return serial / (procs * seconds_per_year(coefficients, columns, procs))
+
+
+def candidate_procs(max_procs, cores_per_node):
+    """Powers of two below one node, then whole nodes."""
+    candidates = set()
+    p = 1
+    while p < min(cores_per_node, max_procs + 1):
+        candidates.add(p)
+        p *= 2
+    candidates.update(range(cores_per_node, max_procs + 1, cores_per_node))
+    return sorted(candidates)
+
+
+def choose_procs(coefficients, columns, candidates, min_efficiency):
+    """The largest candidate that is still efficient enough, and its efficiency."""
+    efficiency = parallel_efficiency(coefficients, columns, candidates)
+    good = [p for p, e in zip(candidates, efficiency) if e >= min_efficiency]
+    # If even one node is too inefficient, take the most efficient choice
+    procs = max(good) if good else candidates[int(np.argmax(efficiency))]
+    return procs, float(efficiency[candidates.index(procs)])
+
+
+def choose_skip_max(samples, coefficients, columns):
+    """Best observed -skip_max on this grid, otherwise scaled with the grid spacing."""
+    ratios = {}
+    for s in samples:
+        if s["columns"] == columns and s["skip_max"]:
+            predicted = seconds_per_year(coefficients, s["columns"], s["numproc"])[0]
+            ratios.setdefault(int(s["skip_max"]), []).append(s["seconds_per_year"] / predicted)
+    if ratios:
+        return min(ratios, key=lambda k: np.mean(ratios[k]))
+    return max(1, int(round(REFERENCE_SKIP_MAX * math.sqrt(float(columns) / REFERENCE_COLUMNS))))
+
+
+def main():
+    args = parse_arguments()
+    fmt = MyFormatter()
+    hdlr = logging.StreamHandler(sys.stderr if args.shell else sys.stdout)
+    hdlr.setFormatter(fmt)
+    logging.root.addHandler(hdlr)
+    logging.root.setLevel(args.loglevel)
+    samples = collect_samples(args)
+    if not samples:
+        if not args.shell:
+            logging.error("No earlier segments found, nothing to fit")
+            sys.exit(1)
+        # The run script keeps its own defaults
+        return
+    if len(set(s["numproc"] for s in samples)) < 2 and args.prior_a is None:
+        # With one process count the fit puts everything into b, which
+        # makes a single process look best
+        logging.warning("All %d segments ran on %d processes, the scaling cannot be fitted; "
+                        "vary numproc or give --prior-a" % (len(samples), samples[0]["numproc"]))
+        if not args.shell:
+            sys.exit(1)
+        return
+    columns = args.Mx * args.My
+    coefficients = fit_scaling_model(samples, args.prior_a)
+    candidates = candidate_procs(args.max_procs, args.cores_per_node)
+    procs, efficiency = choose_procs(coefficients, columns, candidates, args.min_efficiency)
+    skip_max = choose_skip_max(samples, coefficients, columns)
+    throughput = 3600. / seconds_per_year(coefficients, columns, procs)[0]
+    if args.shell:
+        sys.stdout.write("numproc=%d\nskip_max=%d\n" % (procs, skip_max))
+        # stdout is eval'ed by the run script, the expectation goes to its log
+        sys.stderr.write("tune_allocation.py: numproc=%d skip_max=%d, expected %.2f model years "
+                         "per wall hour at %.0f%% parallel efficiency\n"
+                         % (procs, skip_max, throughput, 100 * efficiency))
+        return
+    sys.stdout.write("Fitted to %d segments on %d grid(s)\n"
+                     % (len(samples), len(set(s["columns"] for s in samples))))
+    sys.stdout.write("%6s %12s %10s\n" % ("procs", "years/hour", "efficiency"))
+    for p, e in zip(candidates, parallel_efficiency(coefficients, columns, candidates)):
+        sys.stdout.write("%6d %12.2f %9.0f%%%s\n"
+                         % (p, 3600. / seconds_per_year(coefficients, columns, p)[0], 100 * e,
+                            " <-" if p == procs else ""))
+    sys.stdout.write("Recommended for %d x %d: numproc=%d skip_max=%d, "
+                     "expected %.2f model years per wall hour at %.0f%% parallel efficiency\n"
+                     % (args.Mx, args.My, procs, skip_max, throughput, 100 * efficiency))
+
+if __name__ == '__main__':
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        main()